@@ -0,0 +1,134 @@
+import os
+import struct
+import subprocess
+from collections import namedtuple
+import numpy as np
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# frames mixed per block, the memory used by a mix doesn't depend on the track length
+MIX_BLOCK_FRAMES = 64 * 1024
+
+WavInfo = namedtuple("WavInfo", ["format_tag", "sample_rate", "channels", "bits_per_sample", "data_offset", "frames"])
+
+# read the format and the position of the samples from the wav header
+def read_wav_header(path):
+  file_size = os.path.getsize(path)
+  with open(path, "rb") as f:
+    riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+    if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+      raise ValueError(f"{path} is not a wav file")
+
+    fmt = None
+    while True:
+      chunk_header = f.read(8)
+      if len(chunk_header) < 8:
+        raise ValueError(f"{path} has no data chunk")
+      chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+
+      if chunk_id == b"fmt ":
+        chunk = f.read(chunk_size + (chunk_size & 1))
+        format_tag, channels, sample_rate, _, _, bits_per_sample = struct.unpack("<HHIIHH", chunk[:16])
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+          format_tag = struct.unpack("<H", chunk[24:26])[0]
+        fmt = (format_tag, sample_rate, channels, bits_per_sample)
+      elif chunk_id == b"data":
+        if fmt is None:
+          raise ValueError(f"{path} has no fmt chunk before the data chunk")
+        data_offset = f.tell()
+        # streamed and RF64 files don't have a usable size here, the data runs to the end of the file
+        if chunk_size == 0xFFFFFFFF or data_offset + chunk_size > file_size:
+          chunk_size = file_size - data_offset
+        format_tag, sample_rate, channels, bits_per_sample = fmt
+        frames = chunk_size // (channels * bits_per_sample // 8)
+        return WavInfo(format_tag, sample_rate, channels, bits_per_sample, data_offset, frames)
+      else:
+        f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+# memory map the samples, nothing is read from disk until a block is used
+def _map_samples(path, info):
+  shape = (info.frames, info.channels)
+  if info.format_tag == WAVE_FORMAT_PCM and info.bits_per_sample == 24:
+    return np.memmap(path, dtype=np.uint8, mode="r", offset=info.data_offset, shape=shape + (3,))
+
+  dtypes = {
+    (WAVE_FORMAT_PCM, 8): np.uint8,
+    (WAVE_FORMAT_PCM, 16): np.dtype("<i2"),
+    (WAVE_FORMAT_PCM, 32): np.dtype("<i4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype("<f4"),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype("<f8"),
+  }
+  dtype = dtypes.get((info.format_tag, info.bits_per_sample))
+  if dtype is None:
+    raise ValueError(f"Unsupported wav format {info.format_tag} with {info.bits_per_sample} bits in {path}")
+  return np.memmap(path, dtype=dtype, mode="r", offset=info.data_offset, shape=shape)
+
+# convert a block of samples to float32 in -1..1
+def _to_float(block, info):
+  if info.format_tag == WAVE_FORMAT_IEEE_FLOAT:
+    return block.astype(np.float32)
+  if info.bits_per_sample == 8:
+    return (block.astype(np.float32) - 128) / 128
+  if info.bits_per_sample == 24:
+    samples = block[..., 0].astype(np.int32) | (block[..., 1].astype(np.int32) << 8) | (block[..., 2].astype(np.int32) << 16)
+    samples = np.where(samples >= 1 << 23, samples - (1 << 24), samples)
+    return samples.astype(np.float32) / (1 << 23)
+  return block.astype(np.float32) / float(1 << (info.bits_per_sample - 1))
+
+# mix any number of wav stems block by block and stream the result into ffmpeg for encoding,
+# the output format comes from the output file extension. stems are cut to the shortest one.
+# gains are linear per stem, clip is "hard" to clip at full scale or "soft" for a tanh limiter.
+# raises ValueError when the stems can't be mixed here (not wav, different sample rates, ...)
+def mix_wav_files(input_paths, output_path, gains=None, clip="hard", bitrate=None, block_frames=MIX_BLOCK_FRAMES):
+  infos = [read_wav_header(path) for path in input_paths]
+  gains = gains or [1.0] * len(input_paths)
+  if len(gains) != len(input_paths):
+    raise ValueError("There must be one gain per stem")
+
+  sample_rate = infos[0].sample_rate
+  channels = max(info.channels for info in infos)
+  for info in infos:
+    if info.sample_rate != sample_rate:
+      raise ValueError("All stems must have the same sample rate")
+    if info.channels not in (1, channels):
+      raise ValueError("All stems must have the same number of channels or be mono")
+
+  frames = min(info.frames for info in infos)
+  sources = [_map_samples(path, info) for path, info in zip(input_paths, infos)]
+
+  command = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0"]
+  if bitrate:
+    command += ["-b:a", bitrate]
+  command.append(output_path)
+
+  process = subprocess.Popen(command, stdin=subprocess.PIPE)
+  try:
+    for start in range(0, frames, block_frames):
+      end = min(start + block_frames, frames)
+      mixed = np.zeros((end - start, channels), dtype=np.float32)
+      for source, info, gain in zip(sources, infos, gains):
+        # mono stems are added to every channel
+        mixed += _to_float(source[start:end], info) * gain
+
+      if clip == "soft":
+        mixed = np.tanh(mixed)
+      else:
+        np.clip(mixed, -1.0, 1.0, out=mixed)
+
+      process.stdin.write((mixed * 32767).astype("<i2").tobytes())
+    process.stdin.close()
+  except BaseException:
+    process.kill()
+    process.wait()
+    raise
+
+  if process.wait() != 0:
+    raise Exception(f"ffmpeg failed to encode {output_path}, exit code: {process.returncode}")
+
+  return {
+    "frames": frames,
+    "sample_rate": sample_rate,
+    "channels": channels,
+  }
@@ -0,0 +1,44 @@
+import functools
+import json
+import os
+import subprocess
+from collections import namedtuple
+import mutagen
+
+AudioInfo = namedtuple("AudioInfo", ["duration", "sample_rate", "channels"])
+
+# read the duration (in seconds), sample rate and channel count from the file headers without
+# decoding the audio, ffprobe is used for formats mutagen can't read. results are cached by
+# path, mtime and size so a file that changes is probed again
+def probe_audio(path):
+  stat = os.stat(path)
+  return _probe_cached(path, stat.st_mtime_ns, stat.st_size)
+
+@functools.lru_cache(maxsize=512)
+def _probe_cached(path, mtime_ns, size):
+  return _probe_headers(path) or _probe_ffprobe(path)
+
+def _probe_headers(path):
+  try:
+    audio = mutagen.File(path)
+  except mutagen.MutagenError:
+    return None
+  if audio is None or audio.info is None or not getattr(audio.info, "length", 0):
+    return None
+  return AudioInfo(audio.info.length, getattr(audio.info, "sample_rate", None), getattr(audio.info, "channels", None))
+
+def _probe_ffprobe(path):
+  result = subprocess.run([
+    "ffprobe", "-v", "error", "-select_streams", "a:0",
+    "-show_entries", "stream=sample_rate,channels,duration:format=duration",
+    "-of", "json", path
+  ], capture_output=True, check=True)
+  data = json.loads(result.stdout)
+
+  stream = (data.get("streams") or [{}])[0]
+  duration = stream.get("duration") or data.get("format", {}).get("duration")
+  if duration is None:
+    raise ValueError(f"Unable to read the duration of {path}")
+
+  sample_rate = stream.get("sample_rate")
+  return AudioInfo(float(duration), int(sample_rate) if sample_rate else None, stream.get("channels"))
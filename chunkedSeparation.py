@@ -0,0 +1,121 @@
+import os
+import subprocess
+import uuid
+import numpy as np
+import soundfile as sf
+
+# separate the audio window by window instead of all at once, so peak memory stays flat whatever
+# the track length. windows overlap by overlap_seconds and the seams are crossfaded, the stems are
+# appended to as every window is done and on_chunk(index, instrumental_path, vocal_path) is called
+# after each flush so callers can start using the first part of the stems early.
+# separate is a separate(file_path) function returning the [instrumental, vocal] output file names
+def separate_chunked(separate, file_path, output_dir, chunk_seconds=60, overlap_seconds=2, on_chunk=None):
+  if chunk_seconds <= 2 * overlap_seconds:
+    raise ValueError("chunk_seconds must be more than twice overlap_seconds")
+
+  base_name = os.path.splitext(os.path.basename(file_path))[0]
+  outputs = [f"{base_name}_(Instrumental)_chunked.wav", f"{base_name}_(Vocals)_chunked.wav"]
+  output_paths = [os.path.join(output_dir, output) for output in outputs]
+
+  writers = None
+  tails = [None, None]
+  index = 0
+  source_path = file_path
+  if not _soundfile_can_read(file_path):
+    source_path = _convert_to_wav(file_path, output_dir, base_name)
+
+  try:
+    with sf.SoundFile(source_path) as source:
+      chunk_frames = int(chunk_seconds * source.samplerate)
+      overlap_frames = int(overlap_seconds * source.samplerate)
+      carry = np.zeros((0, source.channels), dtype="float32")
+
+      while True:
+        data = source.read(chunk_frames - len(carry), dtype="float32", always_2d=True)
+        is_last = len(carry) + len(data) < chunk_frames
+        if len(data) == 0 and index > 0:
+          break
+
+        chunk = np.concatenate([carry, data])
+        stems, sample_rate = _separate_window(separate, chunk, source.samplerate, output_dir, base_name, index)
+
+        if writers is None:
+          writers = [sf.SoundFile(path, "w", samplerate=sample_rate, channels=stem.shape[1], subtype="PCM_16") for path, stem in zip(output_paths, stems)]
+
+        overlap_out = int(overlap_seconds * sample_rate)
+        for stem_index, stem in enumerate(stems):
+          tails[stem_index] = _write_with_crossfade(writers[stem_index], tails[stem_index], stem, overlap_out, is_last)
+          writers[stem_index].flush()
+
+        if on_chunk is not None:
+          on_chunk(index, *output_paths)
+
+        if is_last:
+          break
+        carry = chunk[-overlap_frames:] if overlap_frames > 0 else chunk[:0]
+        index += 1
+
+      # the audio ended right on a window boundary, write the tails that were held back
+      for writer, tail in zip(writers, tails):
+        if tail is not None:
+          writer.write(tail)
+  finally:
+    if writers is not None:
+      for writer in writers:
+        writer.close()
+    if source_path != file_path:
+      os.remove(source_path)
+
+  return outputs
+
+def _soundfile_can_read(file_path):
+  try:
+    sf.info(file_path)
+    return True
+  except RuntimeError:
+    return False
+
+# decode formats soundfile can't read (e.g. the m4a and webm of youtube downloads) to a wav with ffmpeg,
+# the wav is read window by window like any other input
+def _convert_to_wav(file_path, output_dir, base_name):
+  wav_path = os.path.join(output_dir, f"{base_name}_source_{uuid.uuid4().hex[:8]}.wav")
+  result = subprocess.run(["ffmpeg", "-nostdin", "-y", "-v", "error", "-i", file_path, "-vn", "-c:a", "pcm_s16le", wav_path], capture_output=True, text=True)
+  if result.returncode != 0:
+    if os.path.exists(wav_path):
+      os.remove(wav_path)
+    raise RuntimeError(f"Failed to decode {file_path}: {result.stderr.strip()[-500:]}")
+  return wav_path
+
+# run one window through the separator and read its stems back
+def _separate_window(separate, chunk, sample_rate, output_dir, base_name, index):
+  chunk_path = os.path.join(output_dir, f"{base_name}_chunk_{index}_{uuid.uuid4().hex[:8]}.wav")
+  sf.write(chunk_path, chunk, sample_rate, subtype="FLOAT")
+  chunk_outputs = []
+  try:
+    chunk_outputs = separate(chunk_path)
+    stems = []
+    for output in chunk_outputs[:2]:
+      stem, stem_sample_rate = sf.read(os.path.join(output_dir, output), dtype="float32", always_2d=True)
+      stems.append(stem)
+    return stems, stem_sample_rate
+  finally:
+    for path in [chunk_path] + [os.path.join(output_dir, output) for output in chunk_outputs]:
+      if os.path.exists(path):
+        os.remove(path)
+
+# write a stem window, blending its head with the tail kept from the previous window.
+# returns the tail of this window, held back until the next window arrives
+def _write_with_crossfade(writer, tail, stem, overlap_frames, is_last):
+  start = 0
+  if tail is not None:
+    fade_frames = min(len(tail), len(stem))
+    fade_in = np.linspace(0.0, 1.0, fade_frames, dtype="float32")[:, None]
+    writer.write(tail[:fade_frames] * (1.0 - fade_in) + stem[:fade_frames] * fade_in)
+    start = fade_frames
+
+  if is_last or len(stem) - start <= overlap_frames:
+    writer.write(stem[start:])
+    return None
+
+  writer.write(stem[start:len(stem) - overlap_frames])
+  return stem[len(stem) - overlap_frames:]
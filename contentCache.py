@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+ENTRY_FILE_NAME = "entry.json"
+
+# hash a file in chunks so large audio files are never loaded in memory
+def hash_file(path, chunk_size=1024 * 1024):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+# build a cache key from any json serializable parts, e.g. content hashes and parameters
+def make_key(*parts):
+  return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+# hard link the file when possible (same filesystem, no extra disk space), copy it otherwise
+def link_or_copy(source_path, target_path):
+  tmp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+  try:
+    os.link(source_path, tmp_path)
+  except OSError:
+    shutil.copyfile(source_path, tmp_path)
+  os.replace(tmp_path, target_path)
+
+# content addressed cache on disk, every entry is a folder with its files and an entry.json
+# holding the metadata. the entry.json mtime is the last access time used for LRU eviction
+# once the cache grows over max_bytes
+class ContentCache:
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+
+  def _entry_dir(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def get(self, key):
+    entry_dir = self._entry_dir(key)
+    entry_path = os.path.join(entry_dir, ENTRY_FILE_NAME)
+    try:
+      with open(entry_path, "r") as f:
+        entry = json.load(f)
+      # mark the entry as recently used
+      os.utime(entry_path)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return None
+
+    files = {name: os.path.join(entry_dir, name) for name in entry["files"]}
+    # the entry may have been evicted by another worker while we were reading it
+    if not all(os.path.exists(path) for path in files.values()):
+      return None
+
+    return {
+      "key": key,
+      "files": files,
+      "metadata": entry["metadata"],
+    }
+
+  # files is a dict of cache file name -> path of the file to store
+  def put(self, key, files, metadata):
+    os.makedirs(self.cache_dir, exist_ok=True)
+    entry_dir = self._entry_dir(key)
+    tmp_dir = f"{entry_dir}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_dir)
+
+    try:
+      for name, path in files.items():
+        link_or_copy(path, os.path.join(tmp_dir, name))
+      self._write_entry(tmp_dir, {"files": list(files.keys()), "metadata": metadata})
+      os.rename(tmp_dir, entry_dir)
+    except OSError:
+      # another worker stored the same entry first, keep theirs
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+      if not os.path.isdir(entry_dir):
+        raise
+
+    self.evict()
+    return self.get(key)
+
+  def update_metadata(self, key, **fields):
+    entry_dir = self._entry_dir(key)
+    with open(os.path.join(entry_dir, ENTRY_FILE_NAME), "r") as f:
+      entry = json.load(f)
+    entry["metadata"].update(fields)
+    self._write_entry(entry_dir, entry)
+
+  def _write_entry(self, entry_dir, entry):
+    entry_path = os.path.join(entry_dir, ENTRY_FILE_NAME)
+    tmp_path = f"{entry_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(entry, f)
+    os.replace(tmp_path, entry_path)
+
+  # remove the least recently used entries until the cache fits in max_bytes
+  def evict(self):
+    entries = []
+    total_size = 0
+    for name in os.listdir(self.cache_dir):
+      entry_dir = os.path.join(self.cache_dir, name)
+      try:
+        last_access = os.stat(os.path.join(entry_dir, ENTRY_FILE_NAME)).st_mtime
+        size = sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+      except (FileNotFoundError, NotADirectoryError):
+        continue
+      entries.append((last_access, size, entry_dir))
+      total_size += size
+
+    for last_access, size, entry_dir in sorted(entries):
+      if total_size <= self.max_bytes:
+        break
+      shutil.rmtree(entry_dir, ignore_errors=True)
+      total_size -= size
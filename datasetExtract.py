@@ -0,0 +1,108 @@
+import concurrent.futures
+import io
+import os
+import time
+import zipfile
+import httpx
+
+EXTRACT_WORKERS = os.cpu_count() or 4
+# every worker reads the archive ahead in blocks of this size
+READ_AHEAD_SIZE = 4 * 1024 * 1024
+RANGE_READ_RETRIES = 3
+
+# read only, seekable view of a remote file, every read is an http byte range request.
+# wrapped in a BufferedReader it lets zipfile read the archive without downloading it first
+class HTTPRangeFile(io.RawIOBase):
+  def __init__(self, client, url, size):
+    self.client = client
+    self.url = url
+    self.size = size
+    self.position = 0
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self.position
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      self.position = offset
+    elif whence == io.SEEK_CUR:
+      self.position += offset
+    elif whence == io.SEEK_END:
+      self.position = self.size + offset
+    return self.position
+
+  def readinto(self, buffer):
+    end = min(self.position + len(buffer), self.size)
+    if end <= self.position:
+      return 0
+
+    for attempt in range(RANGE_READ_RETRIES):
+      try:
+        response = self.client.get(self.url, headers={"Range": f"bytes={self.position}-{end - 1}"})
+        if response.status_code != 206:
+          raise Exception(f"Expected a partial response, got {response.status_code}")
+        break
+      except httpx.TransportError:
+        if attempt == RANGE_READ_RETRIES - 1:
+          raise
+        time.sleep(2 ** attempt)
+
+    data = response.content
+    buffer[:len(data)] = data
+    self.position += len(data)
+    return len(data)
+
+# split the entries into contiguous groups by their position in the archive,
+# so every worker reads its part of the archive front to back
+def _split_entries(infos, workers):
+  infos = sorted(infos, key=lambda info: info.header_offset)
+  group_size = -(-len(infos) // workers) if infos else 1
+  return [infos[i:i + group_size] for i in range(0, len(infos), group_size)]
+
+def _extract_entries(open_archive, infos, output_path):
+  extracted_files = 0
+  extracted_bytes = 0
+  with open_archive() as archive:
+    for info in infos:
+      try:
+        archive.extract(info, output_path)
+      except FileExistsError:
+        # another worker created the same parent folder at the same time
+        archive.extract(info, output_path)
+      if not info.is_dir():
+        extracted_files += 1
+        extracted_bytes += info.file_size
+  return extracted_files, extracted_bytes
+
+# extract the entries in parallel, open_archive() returns a new ZipFile for every worker
+def _extract_parallel(open_archive, output_path, workers):
+  with open_archive() as archive:
+    infos = archive.infolist()
+
+  groups = _split_entries(infos, workers)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(groups))) as executor:
+    results = list(executor.map(lambda group: _extract_entries(open_archive, group, output_path), groups))
+
+  return {
+    "extracted_files": sum(files for files, _ in results),
+    "extracted_bytes": sum(size for _, size in results),
+  }
+
+# extract a zip file in parallel across cores
+def extract_zip(zip_path, output_path, workers=EXTRACT_WORKERS):
+  return _extract_parallel(lambda: zipfile.ZipFile(zip_path), output_path, workers)
+
+# extract a remote zip straight from the server with byte range requests, entries are decompressed
+# as their bytes arrive and the archive itself is never written to disk.
+# size is the archive size, the server has to support range requests
+def extract_remote_zip(url, size, output_path, workers=EXTRACT_WORKERS):
+  with httpx.Client(timeout=httpx.Timeout(60.0, connect=10.0), follow_redirects=True) as client:
+    def open_archive():
+      return zipfile.ZipFile(io.BufferedReader(HTTPRangeFile(client, url, size), buffer_size=READ_AHEAD_SIZE))
+    return _extract_parallel(open_archive, output_path, workers)
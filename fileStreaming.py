@@ -0,0 +1,90 @@
+import asyncio
+import os
+import re
+from starlette.responses import FileResponse
+
+# bytes read per chunk when the server has no zero-copy send
+READ_CHUNK_SIZE = 1024 * 1024
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# parse a Range header against the file size. returns (start, end) with end inclusive, None to send
+# the whole file (no header, or several ranges which are allowed to be answered with the whole file),
+# or raises ValueError when the range can't be satisfied
+def parse_range(range_header, file_size):
+  if not range_header or "," in range_header:
+    return None
+  match = RANGE_PATTERN.match(range_header.strip())
+  if match is None or match.group(1) == match.group(2) == "":
+    return None
+  start, end = match.groups()
+  if start == "":
+    # suffix range, the last n bytes
+    length = int(end)
+    if length == 0:
+      raise ValueError(f"Unsatisfiable range: {range_header}")
+    return max(0, file_size - length), file_size - 1
+  start = int(start)
+  end = min(int(end), file_size - 1) if end != "" else file_size - 1
+  if start >= file_size or end < start:
+    raise ValueError(f"Unsatisfiable range: {range_header}")
+  return start, end
+
+# file response with single Range support (206 / 416). the body goes through the ASGI zero-copy send
+# extension when the server has it, so the kernel sends the file with sendfile, otherwise it is read in
+# chunks on a thread. the file is opened once before the headers are sent, it can be removed meanwhile.
+# the background task runs even when the client goes away in the middle of the body
+class RangeFileResponse(FileResponse):
+  def __init__(self, path, range_header=None, **kwargs):
+    super().__init__(path, **kwargs)
+    self.range_header = range_header
+    self.headers["accept-ranges"] = "bytes"
+
+  async def __call__(self, scope, receive, send):
+    try:
+      await self._send_file(scope, send)
+    finally:
+      if self.background is not None:
+        await self.background()
+
+  async def _send_file(self, scope, send):
+    file = await asyncio.to_thread(open, self.path, "rb")
+    try:
+      stat_result = os.fstat(file.fileno())
+      self.set_stat_headers(stat_result)
+      file_size = stat_result.st_size
+
+      try:
+        byte_range = parse_range(self.range_header, file_size)
+      except ValueError:
+        self.headers["content-length"] = "0"
+        self.headers["content-range"] = f"bytes */{file_size}"
+        await send({"type": "http.response.start", "status": 416, "headers": self.raw_headers})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return
+
+      status_code = self.status_code
+      offset, count = 0, file_size
+      if byte_range is not None:
+        offset, end = byte_range
+        count = end - offset + 1
+        status_code = 206
+        self.headers["content-range"] = f"bytes {offset}-{end}/{file_size}"
+        self.headers["content-length"] = str(count)
+
+      await send({"type": "http.response.start", "status": status_code, "headers": self.raw_headers})
+      if scope["method"].upper() == "HEAD" or count == 0:
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+      elif "http.response.zerocopysend" in scope.get("extensions", {}):
+        await send({"type": "http.response.zerocopysend", "file": file, "offset": offset, "count": count, "more_body": False})
+      else:
+        await asyncio.to_thread(file.seek, offset)
+        while count > 0:
+          chunk = await asyncio.to_thread(file.read, min(READ_CHUNK_SIZE, count))
+          if not chunk:
+            # the file was truncated while it was sent, the response can't be completed
+            raise RuntimeError(f"File at path {self.path} ended early")
+          count -= len(chunk)
+          await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+    finally:
+      await asyncio.to_thread(file.close)
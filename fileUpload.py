@@ -1,5 +1,9 @@
+import os
+import time
+import concurrent.futures
+import threading
 import boto3
-from dataplane import s3_upload
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
 
 INDEX_FILES_BUCKET = 'vox-ai-model-index-files'
@@ -8,41 +12,180 @@ CONTENT_FILES_BUCKET = 'vox-ai'
 
 CONTENT_FILES_BUCKET_URL = 'https://r2.voxapp.ai'
 
+# can point to a local S3 compatible server (e.g. minio) for testing
+R2_ENDPOINT_URL = os.environ.get("R2_ENDPOINT_URL", 'https://40ad419de279f41e9626e2faf500b6b4.r2.cloudflarestorage.com')
+
+# files larger than the threshold are sent as multipart uploads, with parts sent in parallel
+MULTIPART_THRESHOLD = int(os.environ.get("UPLOAD_MULTIPART_THRESHOLD", str(16 * 1024 * 1024)))
+MULTIPART_PART_SIZE = int(os.environ.get("UPLOAD_PART_SIZE", str(16 * 1024 * 1024)))
+MULTIPART_CONCURRENCY = int(os.environ.get("UPLOAD_PART_CONCURRENCY", "8"))
+# number of files uploaded at the same time by the shared executor
+UPLOAD_MAX_WORKERS = int(os.environ.get("UPLOAD_MAX_WORKERS", "8"))
+
 # define enum for bucket types
 class BucketType:
   INDEX_FILES = 1
   PTH_FILES = 2
   CONTENT_FILES = 3
 
-S3Connect = boto3.client('s3', 
-             endpoint_url='https://40ad419de279f41e9626e2faf500b6b4.r2.cloudflarestorage.com',
+S3Connect = boto3.client('s3',
+             endpoint_url=R2_ENDPOINT_URL,
              aws_access_key_id='7da645d13a990ecc11f684221ed975e3',
              aws_secret_access_key='2ed0fe3463962449e5dbc8a66fb1f5ff49e06ecb2badac62120cc2c8caadc3e0',
-             config=Config(signature_version='s3v4'),
+             config=Config(signature_version='s3v4', max_pool_connections=UPLOAD_MAX_WORKERS * MULTIPART_CONCURRENCY),
              region_name='us-east-1')
-            
-def upload_file(file_path, filename, bucketType: BucketType):
-  print(f"Uploading file {filename}...")
+
+TRANSFER_CONFIG = TransferConfig(
+  multipart_threshold=MULTIPART_THRESHOLD,
+  multipart_chunksize=MULTIPART_PART_SIZE,
+  max_concurrency=MULTIPART_CONCURRENCY,
+  use_threads=True,
+)
+
+# long lived executor shared by every upload of the worker, instead of a new executor per request
+UPLOAD_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="upload")
+
+def get_bucket(bucketType: BucketType):
   if bucketType == BucketType.INDEX_FILES:
-    bucket = INDEX_FILES_BUCKET
+    return INDEX_FILES_BUCKET
   elif bucketType == BucketType.PTH_FILES:
-    bucket = PTH_FILES_BUCKET
+    return PTH_FILES_BUCKET
   elif bucketType == BucketType.CONTENT_FILES:
-    bucket = CONTENT_FILES_BUCKET
+    return CONTENT_FILES_BUCKET
   else:
     raise ValueError("Invalid bucket type")
 
-  rs = s3_upload(Bucket=bucket, 
-            S3Client=S3Connect,
-            SourceFilePath=file_path,
-            TargetFilePath=filename,
-            UploadMethod="File"
-          )
-  if rs['result'] == 'OK':
-      if bucketType == BucketType.CONTENT_FILES:
-        return f"{CONTENT_FILES_BUCKET_URL}/{filename}"
-      else:
-        return rs['Path']
+# public url of a file in the content files bucket
+def content_file_url(filename):
+  return f"{CONTENT_FILES_BUCKET_URL}/{filename}"
+
+# upload the file and return its url together with the upload stats
+def upload_file_with_stats(file_path, filename, bucketType: BucketType):
+  print(f"Uploading file {filename}...")
+  bucket = get_bucket(bucketType)
+
+  file_size = os.path.getsize(file_path)
+  start_time = time.time()
+  try:
+    S3Connect.upload_file(file_path, bucket, filename, Config=TRANSFER_CONFIG)
+  except Exception as e:
+    raise Exception(f"Failed to upload file {filename}, Error: {e}")
+  elapsed_time = max(time.time() - start_time, 1e-6)
+
+  stats = {
+    "file_name": filename,
+    "bytes": file_size,
+    "seconds": elapsed_time,
+    "mb_per_second": file_size / elapsed_time / (1024 * 1024),
+    "parts": -(-file_size // MULTIPART_PART_SIZE) if file_size >= MULTIPART_THRESHOLD else 1,
+  }
+  print(f"Uploaded file {filename}, {stats['bytes']} bytes in {stats['seconds']:.2f}s ({stats['mb_per_second']:.2f} MB/s, {stats['parts']} parts)")
+
+  if bucketType == BucketType.CONTENT_FILES:
+    return content_file_url(filename), stats
   else:
-    raise Exception(f"Failed to upload file {filename}, Response: {rs}")
-  
\ No newline at end of file
+    return filename, stats
+
+def upload_file(file_path, filename, bucketType: BucketType):
+  url, _ = upload_file_with_stats(file_path, filename, bucketType)
+  return url
+
+# upload on the shared executor, returns a concurrent.futures.Future of the url
+def submit_upload(file_path, filename, bucketType: BucketType):
+  return UPLOAD_EXECUTOR.submit(upload_file, file_path, filename, bucketType)
+
+# ProgressiveUpload.finish waits for parts running on the upload executor, it runs on its own threads
+FINISH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS, thread_name_prefix="upload-finish")
+
+# upload a file to R2 while it is still being written, as a multipart upload. grow() is called by the writer
+# after every flush and sends the whole parts written since, on the shared executor. the first part holds the
+# file header, which is only final once the file is closed, so it is sent by finish() with the rest of the file.
+# files smaller than two parts, or whose streaming failed, are sent with a plain upload by finish()
+class ProgressiveUpload:
+  def __init__(self, file_path, filename, bucketType: BucketType):
+    self.file_path = file_path
+    self.filename = filename
+    self.bucketType = bucketType
+    self.bucket = get_bucket(bucketType)
+    self.upload_id = None
+    # part number -> future of its ETag
+    self.parts = {}
+    # bytes covered by the parts sent so far, part 1 is reserved
+    self.sent_bytes = MULTIPART_PART_SIZE
+    self.failed = False
+    self.lock = threading.Lock()
+    # guards the creation of the multipart upload by the first part sent, parts run concurrently
+    self.upload_id_lock = threading.Lock()
+
+  # create the multipart upload on the first part, so grow() never makes a request on the writer thread
+  def _ensure_upload_id(self):
+    with self.upload_id_lock:
+      if self.upload_id is None:
+        self.upload_id = S3Connect.create_multipart_upload(Bucket=self.bucket, Key=self.filename)["UploadId"]
+      return self.upload_id
+
+  def _upload_part(self, number, offset, size):
+    upload_id = self._ensure_upload_id()
+    with open(self.file_path, "rb") as f:
+      f.seek(offset)
+      data = f.read(size)
+    response = S3Connect.upload_part(Bucket=self.bucket, Key=self.filename, UploadId=upload_id, PartNumber=number, Body=data)
+    return response["ETag"]
+
+  def grow(self):
+    with self.lock:
+      if self.failed:
+        return
+      try:
+        size = os.path.getsize(self.file_path)
+        while size - self.sent_bytes >= MULTIPART_PART_SIZE:
+          number = len(self.parts) + 2
+          self.parts[number] = UPLOAD_EXECUTOR.submit(self._upload_part, number, self.sent_bytes, MULTIPART_PART_SIZE)
+          self.sent_bytes += MULTIPART_PART_SIZE
+      except Exception as e:
+        print(f"Streaming upload of {self.filename} failed, it will be uploaded once finished. Error: {e}")
+        self.failed = True
+
+  def abort(self):
+    with self.lock:
+      self._abort()
+
+  def _abort(self):
+    # the upload is created by the first part, wait for the parts before looking at it
+    concurrent.futures.wait(self.parts.values())
+    if self.upload_id is None:
+      return
+    try:
+      S3Connect.abort_multipart_upload(Bucket=self.bucket, Key=self.filename, UploadId=self.upload_id)
+    except Exception as e:
+      print(f"Failed to abort the upload of {self.filename}, Error: {e}")
+    self.upload_id = None
+
+  # send the first part and the rest of the closed file and complete the upload, returns the url.
+  # blocks until the parts sent by grow() are done, don't call it from the upload executor
+  def finish(self):
+    with self.lock:
+      if self.parts and not self.failed:
+        try:
+          etags = {number: future.result() for number, future in self.parts.items()}
+          etags[1] = self._upload_part(1, 0, MULTIPART_PART_SIZE)
+          size = os.path.getsize(self.file_path)
+          if size > self.sent_bytes:
+            etags[len(etags) + 1] = self._upload_part(len(etags) + 1, self.sent_bytes, size - self.sent_bytes)
+          S3Connect.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.filename,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": [{"ETag": etag, "PartNumber": number} for number, etag in sorted(etags.items())]},
+          )
+          self.upload_id = None
+          print(f"Uploaded file {self.filename} while it was written, {size} bytes in {len(etags)} parts")
+          return content_file_url(self.filename) if self.bucketType == BucketType.CONTENT_FILES else self.filename
+        except Exception as e:
+          print(f"Streaming upload of {self.filename} failed, uploading it again. Error: {e}")
+      self._abort()
+    return upload_file(self.file_path, self.filename, self.bucketType)
+
+  # finish on FINISH_EXECUTOR, returns a concurrent.futures.Future of the url
+  def submit_finish(self):
+    return FINISH_EXECUTOR.submit(self.finish)
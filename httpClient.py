@@ -0,0 +1,88 @@
+import asyncio
+import os
+import random
+from urllib.parse import urlsplit
+import httpx
+
+# connection pool shared by every download in the worker
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+MAX_CONNECTIONS_PER_HOST = 8
+TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.5
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_client = None
+_host_limits = {}
+
+def get_client():
+  global _client
+  if _client is None or _client.is_closed:
+    _client = httpx.AsyncClient(
+      limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+      timeout=TIMEOUT,
+      follow_redirects=True,
+    )
+  return _client
+
+async def close_client():
+  global _client
+  if _client is not None:
+    await _client.aclose()
+    _client = None
+
+# limit the number of requests in flight to a single host
+def host_limit(url):
+  host = urlsplit(url).netloc
+  if host not in _host_limits:
+    _host_limits[host] = asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST)
+  return _host_limits[host]
+
+def default_should_retry(response):
+  return response.status_code in RETRY_STATUS_CODES
+
+# exponential backoff with jitter, awaited so the event loop keeps running while we wait
+async def backoff(attempt):
+  await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2 ** attempt + random.uniform(0, RETRY_BACKOFF_SECONDS))
+
+# send a request and retry on connection errors and on responses should_retry accepts,
+# the last response is returned even if it should have been retried
+async def request(method, url, should_retry=default_should_retry, max_retries=MAX_RETRIES, **kwargs):
+  for attempt in range(max_retries):
+    try:
+      async with host_limit(url):
+        response = await get_client().request(method, url, **kwargs)
+    except httpx.TransportError:
+      if attempt == max_retries - 1:
+        raise
+    else:
+      if attempt == max_retries - 1 or not should_retry(response):
+        return response
+    await backoff(attempt)
+
+# stream a url to a file, the download is retried from the start on connection errors.
+# file_path can be a function of the response, e.g. to name the file from its headers
+async def download_to_file(url, file_path, max_retries=MAX_RETRIES):
+  for attempt in range(max_retries):
+    try:
+      async with host_limit(url):
+        async with get_client().stream("GET", url) as response:
+          if response.status_code in RETRY_STATUS_CODES and attempt < max_retries - 1:
+            raise httpx.HTTPStatusError(f"Retryable status code {response.status_code}", request=response.request, response=response)
+          response.raise_for_status()
+
+          path = file_path(response) if callable(file_path) else file_path
+          os.makedirs(os.path.dirname(path), exist_ok=True)
+          # the disk writes run on a thread so a slow disk never stalls the event loop
+          with await asyncio.to_thread(open, path, "wb") as f:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+              await asyncio.to_thread(f.write, chunk)
+          return path
+    except (httpx.TransportError, httpx.HTTPStatusError) as e:
+      retryable = isinstance(e, httpx.TransportError) or e.response.status_code in RETRY_STATUS_CODES
+      if not retryable or attempt == max_retries - 1:
+        raise
+    await backoff(attempt)
@@ -1,18 +1,38 @@
 from typing import Union
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from starlette.background import BackgroundTask
 import json
 import base64
 import time
-import requests
 import concurrent.futures
+import contextlib
+import threading
 import os
+import uuid
 from urllib.parse import unquote
 import random
-from audio_separator.separator import Separator
+import math
 from pydub import AudioSegment
 import shutil
-from fileUpload import upload_file, BucketType
+from fileUpload import upload_file, submit_upload, content_file_url, ProgressiveUpload, BucketType, UPLOAD_EXECUTOR
+from separationJobs import JobStore, JobStatus
+from separationServer import SeparationClient, create_separator, separation_concurrency, SEPARATION_MODEL_NAME, SEPARATION_VR_PARAMS
+from contentCache import ContentCache, hash_file, make_key, link_or_copy
+from chunkedSeparation import separate_chunked
+from httpClient import request as http_request, download_to_file, close_client as close_http_client
+from rangedDownload import download_ranged, probe_range_support
+from datasetExtract import extract_zip, extract_remote_zip
+from audioMixer import mix_wav_files
+from audioProbe import probe_audio
+from scheduler import Scheduler, Overloaded
+from modelIndex import ModelIndex
+from scratchJanitor import ScratchJanitor, remove_path
+from streamingUpload import receive_upload
+from fileStreaming import RangeFileResponse
+from video_generation.generate_video import render_video, run_ffmpeg, blur_cover_image, RenderError, TEMPLATE_VERSION
+from video_generation.encoders import encoder_args, select_encoder
 import asyncio
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry._logs import set_logger_provider
@@ -47,6 +67,46 @@ APPLIO_ASSETS_PATH= APPLIO_ROOT_PATH + APPLIO_ASSETS_DIR
 APPLIO_AUDIO_OUTPUT_PATH= APPLIO_ASSETS_PATH + APPLIO_AUDIO_DIR
 APPLIO_DATASET_OUTPUT_PATH= APPLIO_ASSETS_PATH + APPLIO_DATASETS_DIR
 AUDIO_MANIPULATOR_VIDEO_GENERATION_PATH = AUDIO_MANIPULATOR_ROOT_PATH + "video_generation/"
+SEPARATION_JOBS_PATH = AUDIO_MANIPULATOR_ROOT_PATH + "jobs/"
+CACHE_ROOT_PATH = AUDIO_MANIPULATOR_ROOT_PATH + "cache/"
+SEPARATION_CACHE_PATH = CACHE_ROOT_PATH + "separation/"
+# disk budget of the separation cache, least recently used results are evicted past it
+SEPARATION_CACHE_MAX_BYTES = int(os.environ.get("SEPARATION_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+BLUR_CACHE_PATH = CACHE_ROOT_PATH + "blur/"
+# disk budget of the blurred video backgrounds, a background is around 100KB
+BLUR_CACHE_MAX_BYTES = int(os.environ.get("BLUR_CACHE_MAX_BYTES", str(1024 ** 3)))
+VIDEO_OUTPUT_SIZE = "1024x1024"
+VIDEO_CACHE_PATH = CACHE_ROOT_PATH + "video/"
+# disk budget of the rendered videos, least recently used videos are evicted past it
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get("VIDEO_CACHE_MAX_BYTES", str(10 * 1024 ** 3)))
+# window and crossfade sizes used when separating long audio in chunks
+SEPARATION_CHUNK_SECONDS = 60
+SEPARATION_CHUNK_OVERLAP_SECONDS = 2
+# total time allowed for downloading, separating and uploading, kept under the gunicorn timeout
+SEPARATION_DEADLINE_SECONDS = int(os.environ.get("SEPARATION_DEADLINE_SECONDS", "280"))
+# number of separations that can run at the same time in one worker, the rest wait in the executor queue
+INFERENCE_MAX_WORKERS = int(os.environ.get("INFERENCE_MAX_WORKERS", "1"))
+# max number of separation jobs a worker accepts before rejecting new ones
+SEPARATION_JOB_QUEUE_LIMIT = int(os.environ.get("SEPARATION_JOB_QUEUE_LIMIT", "32"))
+# unix socket of the shared separation model server, when not set the model is loaded in this worker
+SEPARATION_SERVER_ADDRESS = os.environ.get("SEPARATION_SERVER_ADDRESS")
+# max number of spectrogram windows batched across concurrent separations when the model is loaded in this worker
+SEPARATION_MAX_BATCH_SIZE = int(os.environ.get("SEPARATION_MAX_BATCH_SIZE", "1"))
+# node wide admission control, slots are shared by all the workers of the node. requests wait in a
+# bounded queue when all the slots of their pool are taken and are rejected with a 429 once it is full
+SCHEDULER_PATH = AUDIO_MANIPULATOR_ROOT_PATH + "scheduler/"
+SCHEDULER_INFERENCE_SLOTS = int(os.environ.get("SCHEDULER_INFERENCE_SLOTS", "2"))
+SCHEDULER_ENCODING_SLOTS = int(os.environ.get("SCHEDULER_ENCODING_SLOTS", str(max(1, (os.cpu_count() or 4) // 4))))
+SCHEDULER_IO_SLOTS = int(os.environ.get("SCHEDULER_IO_SLOTS", "16"))
+SCHEDULER_QUEUE_SIZE = int(os.environ.get("SCHEDULER_QUEUE_SIZE", "16"))
+# scratch files are removed in the background once they are older than their ttl, and the oldest
+# ones first when the scratch folders grow over the disk budget
+JANITOR_PATH = AUDIO_MANIPULATOR_ROOT_PATH + "janitor/"
+SCRATCH_TTL_SECONDS = int(os.environ.get("SCRATCH_TTL_SECONDS", str(6 * 3600)))
+SEPARATION_JOBS_TTL_SECONDS = int(os.environ.get("SEPARATION_JOBS_TTL_SECONDS", str(24 * 3600)))
+SCRATCH_MAX_BYTES = int(os.environ.get("SCRATCH_MAX_BYTES", str(50 * 1024 ** 3)))
+# max size of the audio streamed to the /generate_video_stream endpoints
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(200 * 1024 ** 2)))
 SERVICE_NAME= "AudioManipulator"
 
 # OpenTelemetry Common Setup
@@ -85,10 +145,72 @@ tracer.add_span_processor(
 )
 
 logger.info("Starting the FastAPI server...")
-separator = Separator(output_dir=APPLIO_AUDIO_OUTPUT_PATH, vr_params= { "batch_size": 1,"window_size": 512,"aggression": 5,"enable_tta": False,"enable_post_process": False,"post_process_threshold": 0.2,"high_end_process": False })
-separator.load_model("9_HP2-UVR.pth")
+if SEPARATION_SERVER_ADDRESS:
+   logger.info(f"Using the shared separation server at: {SEPARATION_SERVER_ADDRESS}")
+   separator = SeparationClient(SEPARATION_SERVER_ADDRESS)
+else:
+   separator = create_separator(APPLIO_AUDIO_OUTPUT_PATH, SEPARATION_MAX_BATCH_SIZE)
+
+# separation is blocking, run it on a dedicated bounded executor so it never blocks the event loop
+inference_executor = concurrent.futures.ThreadPoolExecutor(max_workers=separation_concurrency(separator, INFERENCE_MAX_WORKERS), thread_name_prefix="inference")
+job_store = JobStore(SEPARATION_JOBS_PATH)
+separation_cache = ContentCache(SEPARATION_CACHE_PATH, SEPARATION_CACHE_MAX_BYTES)
+blur_cache = ContentCache(BLUR_CACHE_PATH, BLUR_CACHE_MAX_BYTES)
+video_cache = ContentCache(VIDEO_CACHE_PATH, VIDEO_CACHE_MAX_BYTES)
+scheduler = Scheduler(SCHEDULER_PATH, {
+   "inference": (SCHEDULER_INFERENCE_SLOTS, SCHEDULER_QUEUE_SIZE),
+   "encoding": (SCHEDULER_ENCODING_SLOTS, SCHEDULER_QUEUE_SIZE),
+   "io": (SCHEDULER_IO_SLOTS, SCHEDULER_QUEUE_SIZE * 4),
+}, metrics.get_meter(SERVICE_NAME))
+model_index = ModelIndex(APPLIO_LOGS_PATH, APPLIO_LOGS_DIR)
+janitor = ScratchJanitor({
+   APPLIO_AUDIO_OUTPUT_PATH: SCRATCH_TTL_SECONDS,
+   SEPARATION_JOBS_PATH: SEPARATION_JOBS_TTL_SECONDS,
+}, JANITOR_PATH, SCRATCH_MAX_BYTES)
+# keep a reference to the running job tasks so they are not garbage collected
+separation_job_tasks = set()
+# same for the uploads that continue after their response was sent
+background_upload_tasks = set()
+# and the cleanups of the separations cancelled by their deadline
+abandoned_separation_tasks = set()
+
 app = FastAPI()
 
+# detecting the encoders runs test encodes, do it once before the first render instead of during one
+@app.on_event("startup")
+async def startup():
+   encoder = await asyncio.get_running_loop().run_in_executor(None, select_encoder)
+   logger.info(f"Video encoder: {encoder}")
+   # read the logs folder once so the model file lookups don't have to
+   try:
+      await asyncio.get_running_loop().run_in_executor(None, model_index.refresh)
+   except FileNotFoundError:
+      logger.warn(f"The logs folder doesn't exist yet: {APPLIO_LOGS_PATH}")
+   janitor.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+   await janitor.stop()
+   await close_http_client()
+
+# the node has no capacity left for the request, tell the client when to retry
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, e: Overloaded):
+   logger.warn(f"Rejecting {request.url.path}, no {e.pool} capacity left, retry after {e.retry_after} seconds")
+   return JSONResponse(
+      status_code=429,
+      headers={"Retry-After": str(e.retry_after)},
+      content={
+         "status": "error",
+         "error": str(e)
+      }
+   )
+
+# slots in use and queued requests of every pool, for the load balancer
+@app.get("/scheduler_status")
+def scheduler_status():
+   return scheduler.status()
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -124,32 +246,17 @@ async def download_audio(input_url: str):
       "Accept": "application/json"         # Specify that you accept JSON responses
    }
 
-   # Number of retries
-   max_retries = 5
-
    # Initialize response variable
    response = None
-   filename = None
    newPath = None
 
-   # Retry loop
-   for attempt in range(max_retries):
-      try:
-         # Send the POST request to the API with headers
-         response = requests.post(api_url, data=request_body_json, headers=headers)
-
-         # If the response status code is 200, break out of the loop
-         if response.status_code == 200:
-            logger.info("Audio download request succeeded.")
-            break
-         else:
-            logger.warn(f"Received 400 response, retrying... (Attempt {attempt + 1}/{max_retries})")
-
-         # Wait for 1 second before retrying
-         time.sleep(1)
-      except Exception as e:
-         logger.error(f"An error occurred: {e}")
-         break
+   # Send the POST request to the API, retried with backoff until it returns 200
+   try:
+      response = await http_request("POST", api_url, content=request_body_json, headers=headers, should_retry=lambda rs: rs.status_code != 200)
+      if response.status_code == 200:
+         logger.info("Audio download request succeeded.")
+   except Exception as e:
+      logger.error(f"An error occurred: {e}")
 
    # Check if the request was successful (status code 200)
    if response and response.status_code == 200:
@@ -161,34 +268,25 @@ async def download_audio(input_url: str):
          # Extract the audio URL from the response
          audio_url = response_data["url"]
 
-         # Download the audio using wget
          logger.info("Downloading audio...")
-         filename = ""
 
-         responseAudio = requests.get(audio_url, stream=True)
-         if response.status_code == 200:
-            content_disposition = response.headers.get('Content-Disposition')
-            if content_disposition:
+         # name the file from the Content-Disposition header of the audio response
+         def audio_file_path(responseAudio):
+            content_disposition = responseAudio.headers.get('Content-Disposition')
+            if content_disposition and 'filename=' in content_disposition:
                filename = unquote(content_disposition.split('filename=')[1].strip('"'))
             else:
                # need a temp random filename
                filename = f"audio_{random.randint(1000, 9999)}.wav"
+            path = os.path.join(APPLIO_AUDIO_OUTPUT_PATH, filename)
+            logger.info(f"Downloading audio to: {path}")
+            return path
 
-            try:   
-               newPath = os.path.join(APPLIO_AUDIO_OUTPUT_PATH, filename)
-               logger.info(f"Downloading audio to: {newPath}")
-               os.makedirs(os.path.dirname(newPath), exist_ok=True)
-
-               with open(newPath, 'wb') as f:
-                  for chunk in responseAudio.iter_content(1024):
-                     f.write(chunk)
-
-               logger.info(f"Audio downloaded successfully. Saved as: {newPath}")
-            except Exception as e:
-               logger.error(f"An error occurred while writing the audio file: {e}")
-               return await download_video(input_url)
-         else:
-            logger.error("Status code is not 200.")
+         try:
+            newPath = await download_to_file(audio_url, audio_file_path)
+            logger.info(f"Audio downloaded successfully. Saved as: {newPath}")
+         except Exception as e:
+            logger.error(f"An error occurred while downloading the audio file: {e}")
             return await download_video(input_url)
 
       else:
@@ -222,46 +320,328 @@ async def download_video(video_url: str):
 
 @app.post("/download_audio_file")
 async def download_file(input_url: str):
-   # download file from url
-   response = requests.get(input_url, stream=True)
+   return await fetch_input_file(input_url)
+
+# download the file of the url to APPLIO_AUDIO_OUTPUT_PATH, large files are fetched in parallel byte ranges.
+# wait_for_slot queues for an io slot instead of failing with Overloaded, for work that was already accepted
+async def fetch_input_file(input_url, wait_for_slot=False):
    # get file name from url
    filename = input_url.split('/')[-1]
-   # save the file
-   with open(APPLIO_AUDIO_OUTPUT_PATH + filename, 'wb') as f:
-      shutil.copyfileobj(response.raw, f)
+   async with scheduler.slot("io", block=wait_for_slot):
+      await download_ranged(input_url, APPLIO_AUDIO_OUTPUT_PATH + filename)
    return {
       "file_path": APPLIO_AUDIO_OUTPUT_PATH + filename
    }
    
 # download a dataset zip file from the url and extract it to APPLIO_DATASET_OUTPUT_PATH
 @app.post("/download_dataset")
-async def download_dataset(input_url: str):
-   # download file from url
-   response = requests.get(input_url, stream=True)
+async def download_dataset(input_url: str, stream_extract: bool = False):
    # get file name from url
    filename = input_url.split('/')[-1]
    filename_without_ext = filename.split('.')[0]
-   # save the file
-   with open(APPLIO_DATASET_OUTPUT_PATH + filename, 'wb') as f:
-      shutil.copyfileobj(response.raw, f)
-   # extract the zip file
-   shutil.unpack_archive(APPLIO_DATASET_OUTPUT_PATH + filename, APPLIO_DATASET_OUTPUT_PATH + filename_without_ext)
-   # delete the zip file
-   os.remove(APPLIO_DATASET_OUTPUT_PATH + filename)
+
+   if stream_extract and filename.endswith(".zip"):
+      return await stream_extract_dataset(input_url, filename, filename_without_ext)
+
+   # download file from url and save it, large files are fetched in parallel byte ranges
+   await download_ranged(input_url, APPLIO_DATASET_OUTPUT_PATH + filename)
+   # extract the zip file and delete it, off the event loop
+   loop = asyncio.get_running_loop()
+   await loop.run_in_executor(None, shutil.unpack_archive, APPLIO_DATASET_OUTPUT_PATH + filename, APPLIO_DATASET_OUTPUT_PATH + filename_without_ext)
+   await loop.run_in_executor(None, os.remove, APPLIO_DATASET_OUTPUT_PATH + filename)
    return {
       "dataset_path": APPLIO_DATASET_OUTPUT_PATH + filename_without_ext,
       "short_dataset_path": APPLIO_ASSETS_DIR + APPLIO_DATASETS_DIR + filename_without_ext
    }
 
+# run the separation on the inference executor, on_start is called when a worker picks it up.
+# chunked separates the audio window by window so memory doesn't grow with the track length,
+# on_chunk(index, instrumental_path, vocal_path) is called every time a window was appended to the stems.
+# on_submit(future) gets the concurrent.futures.Future of the separation, it keeps running when the caller is cancelled
+async def run_inference(file_path, on_start=None, chunked=False, on_chunk=None, on_submit=None):
+   def separate():
+      if on_start is not None:
+         on_start()
+      if chunked:
+         return separate_chunked(separator.separate, file_path, APPLIO_AUDIO_OUTPUT_PATH, SEPARATION_CHUNK_SECONDS, SEPARATION_CHUNK_OVERLAP_SECONDS, on_chunk)
+      return separator.separate(file_path)
+
+   future = inference_executor.submit(separate)
+   if on_submit is not None:
+      on_submit(future)
+   return await asyncio.wrap_future(future)
+
+# separation results are cached by the audio content, the model and its parameters
+def separation_cache_key(file_path, chunked=False):
+   return make_key(hash_file(file_path), SEPARATION_MODEL_NAME, SEPARATION_VR_PARAMS, chunked)
+
+# stems are stored under the file names the separator gave them
+def store_separation_in_cache(cache_key, outputs):
+   files = {output: APPLIO_AUDIO_OUTPUT_PATH + output for output in outputs}
+   separation_cache.put(cache_key, files, {"outputs": outputs})
+
+# put the cached stems back in the audio output folder, callers can clean them up like freshly separated stems.
+# a hard link keeps the mtime of the cached file, it is touched so the janitor ages it from now
+def restore_cached_stems(cached):
+   outputs = cached["metadata"]["outputs"]
+   for output in outputs:
+      link_or_copy(cached["files"][output], APPLIO_AUDIO_OUTPUT_PATH + output)
+      os.utime(APPLIO_AUDIO_OUTPUT_PATH + output)
+   return outputs
+
+# blurred video background of a cover image, cached by the cover bytes and the output size so
+# the default and popular covers are only blurred once. returns the path of the cached background
+def blurred_background(cover_image_path, output_size):
+   cache_key = make_key("blur", hash_file(cover_image_path), output_size)
+   cached = blur_cache.get(cache_key)
+   if cached is not None:
+      return cached["files"]["background.jpg"]
+
+   blur_cover_path = f"{APPLIO_AUDIO_OUTPUT_PATH}blur_{uuid.uuid4().hex}.jpg"
+   try:
+      blur_cover_image(cover_image_path, blur_cover_path, output_size)
+      return blur_cache.put(cache_key, {"background.jpg": blur_cover_path}, {})["files"]["background.jpg"]
+   finally:
+      if os.path.exists(blur_cover_path):
+         os.remove(blur_cover_path)
+
+# rendered videos are cached by the audio and cover bytes and the template parameters, the same
+# audio and cover give the same video and its R2 url is returned instead of rendering it again
+def video_cache_key(template, audio_file_path, cover_image_path, output_size):
+   return make_key("video", template, TEMPLATE_VERSION, hash_file(audio_file_path), hash_file(cover_image_path), output_size)
+
+def store_video_in_cache(cache_key, video_path, r2_video_url, video_key):
+   video_cache.put(cache_key, {"video.mp4": video_path}, {"r2_video_url": r2_video_url, "video_key": video_key})
+
+# returns a function that runs callback once it has been called count times, from any thread
+def run_after(count, callback):
+   lock = threading.Lock()
+   remaining = [count]
+   def done(*args):
+      with lock:
+         remaining[0] -= 1
+         if remaining[0] != 0:
+            return
+      callback()
+   return done
+
+# upload the file to R2 on the shared executor without waiting for it, the file is pinned until the upload
+# is done. on_done(url) runs on the upload thread, with None when the upload failed. returns the url the
+# file will have once it is uploaded
+def upload_in_background(file_path, file_name, on_done=None):
+   pins = contextlib.ExitStack()
+   pins.enter_context(janitor.pin(file_path))
+   def uploaded(future):
+      url = None
+      try:
+         url = future.result()
+         logger.info(f"Uploaded {file_name} to R2 in the background. URL: {url}")
+      except Exception as e:
+         logger.error(f"Background upload of {file_name} failed: {str(e)}")
+      try:
+         if on_done is not None:
+            on_done(url)
+      except Exception as e:
+         logger.error(f"Error occurred after the background upload of {file_name}: {str(e)}")
+      finally:
+         pins.close()
+   submit_upload(file_path, file_name, BucketType.CONTENT_FILES).add_done_callback(uploaded)
+   return content_file_url(file_name)
+
+# send the file in the response body instead of a json payload, with Range support so an interrupted
+# download can be resumed. the file is pinned while it is sent, on_sent runs on a thread afterwards
+def stream_output_file(request: Request, file_path, headers=None, on_sent=None):
+   pins = contextlib.ExitStack()
+   pins.enter_context(janitor.pin(file_path))
+   def sent():
+      pins.close()
+      if on_sent is not None:
+         on_sent()
+   return RangeFileResponse(
+      file_path,
+      range_header=request.headers.get("range"),
+      headers={"X-File-Path": file_path, **(headers or {})},
+      background=BackgroundTask(sent),
+   )
+
+# extract the dataset zip in parallel across cores. when the server supports ranges the entries are
+# extracted straight from it while they arrive and the zip is never written to disk
+async def stream_extract_dataset(input_url, filename, filename_without_ext):
+   start_time = time.time()
+   loop = asyncio.get_running_loop()
+   dataset_path = APPLIO_DATASET_OUTPUT_PATH + filename_without_ext
+
+   try:
+      zip_size = await probe_range_support(input_url)
+   except Exception as e:
+      logger.error(f"Error occurred while checking range support, URL: {input_url}, error: {str(e)}")
+      zip_size = None
+
+   if zip_size is not None:
+      logger.info(f"Extracting the dataset from the URL while downloading... URL: {input_url}")
+      stats = await loop.run_in_executor(None, extract_remote_zip, input_url, zip_size, dataset_path)
+   else:
+      logger.info(f"Server doesn't support ranges, downloading the dataset first... URL: {input_url}")
+      zip_path = APPLIO_DATASET_OUTPUT_PATH + filename
+      await download_ranged(input_url, zip_path)
+      try:
+         stats = await loop.run_in_executor(None, extract_zip, zip_path, dataset_path)
+      finally:
+         await loop.run_in_executor(None, os.remove, zip_path)
+
+   logger.info(f"Dataset extracted in {time.time() - start_time} seconds, files: {stats['extracted_files']}, bytes: {stats['extracted_bytes']}")
+
+   return {
+      "dataset_path": dataset_path,
+      "short_dataset_path": APPLIO_ASSETS_DIR + APPLIO_DATASETS_DIR + filename_without_ext,
+      "extracted_files": stats["extracted_files"],
+      "extracted_bytes": stats["extracted_bytes"]
+   }
+
 # get the audio file path and separate the audio and save into same folder with suffix _separated
+# with "delivery": "stream" the "stem" ("vocal" or "instrumental") is sent in the response body, and for the
+# vocal remover the files are uploaded to R2 in the background with their urls in the X-R2-* headers
 @app.post("/separate_audio")
-async def separate_audio(request_body: dict):
+async def separate_audio(request_body: dict, request: Request):
+   scheduler.check("inference")
+   if request_body.get("delivery") != "stream":
+      return await process_separation(request_body)
+
+   stem = request_body.get("stem", "vocal")
+   if stem not in ("vocal", "instrumental"):
+      return {
+         "status": "error",
+         "error": f"Unknown stem: {stem}"
+      }
+
+   # the uploads don't hold the response back, files already uploaded for the same audio are not uploaded again
+   if not request_body.get("r2_upload", True):
+      request_body = {**request_body, "purpose": None}
+   result = await process_separation(request_body, background_upload=True)
+   if result.get("status") == "error":
+      return JSONResponse(status_code=500, content=result)
+
+   headers = {}
+   if "r2_original_file_url" in result:
+      headers["X-R2-Original-File-Url"] = result["r2_original_file_url"]
+      headers["X-R2-Instrumental-File-Url"] = result["r2_instrumental_file_url"]
+      headers["X-R2-Vocal-File-Url"] = result["r2_vocal_file_url"]
+
+   return stream_output_file(request, result[f"{stem}_file_path"], headers)
+
+# submit a separation job, the job id is returned right away and the separation runs in the background
+@app.post("/separate_audio_job")
+async def submit_separation_job(request_body: dict):
+   if len(separation_job_tasks) >= SEPARATION_JOB_QUEUE_LIMIT:
+      logger.warn(f"Separation job queue is full, rejecting job for audio_id: {request_body.get('audio_id')}")
+      return {
+         "status": "error",
+         "error": "Too many separation jobs queued, try again later."
+      }
+   scheduler.check("inference")
+
+   job_id = job_store.create(request_body)
+   task = asyncio.create_task(run_separation_job(job_id, request_body))
+   separation_job_tasks.add(task)
+   task.add_done_callback(separation_job_tasks.discard)
+
+   logger.info(f"Separation job queued, job_id: {job_id}, audio_id: {request_body.get('audio_id')}")
+
+   return {
+      "status": JobStatus.QUEUED,
+      "job_id": job_id
+   }
+
+# get the status of a separation job, the result has the same payload as /separate_audio once it is done
+@app.get("/separate_audio_job/{job_id}")
+async def get_separation_job(job_id: str):
+   job = job_store.get(job_id)
+   if job is None:
+      return {
+         "status": "error",
+         "error": f"Job not found, job_id: {job_id}"
+      }
+   return job
+
+async def run_separation_job(job_id, request_body):
+   def mark_running():
+      job_store.update(job_id, status=JobStatus.RUNNING)
+
+   try:
+      # jobs are not bound by the http timeout, so they run without the deadline. they were admitted
+      # when they were submitted, so they wait for an inference slot instead of being rejected
+      result = await process_separation(request_body, on_inference_start=mark_running, deadline=None, wait_for_slot=True)
+   except Exception as e:
+      logger.error(f"Separation job failed, job_id: {job_id}, error: {str(e)}")
+      result = {
+         "status": "error",
+         "error": f"Error occurred while separating audio: {str(e)}"
+      }
+
+   job_status = JobStatus.ERROR if result.get("status") == "error" else JobStatus.DONE
+   job_store.update(job_id, status=job_status, result=result)
+   logger.info(f"Separation job finished, job_id: {job_id}, status: {job_status}")
+
+# run the download, separation and upload stages within the total deadline, None for no deadline
+# with background_upload the response doesn't wait for the R2 uploads, it has the urls the files will have
+async def process_separation(request_body: dict, on_inference_start=None, deadline=SEPARATION_DEADLINE_SECONDS, wait_for_slot=False, background_upload=False):
+   # what the pipeline has in flight, to clean it up when the deadline cancels it
+   state = {}
+   try:
+      return await asyncio.wait_for(separation_pipeline(request_body, on_inference_start, wait_for_slot, background_upload, state), timeout=deadline)
+   except asyncio.TimeoutError:
+      logger.error(f"Audio separation timed out after {deadline} seconds, audio_id: {request_body.get('audio_id')}\n")
+      abandon_separation(state)
+      return {
+         "status": "error",
+         "error": f"Audio separation did not finish within {deadline} seconds"
+      }
+
+# clean up a separation cancelled by its deadline, in the background so the response isn't held back.
+# the inference thread can't be stopped and keeps running past the deadline, it keeps its inference slot
+# and the pin of its input until it is done. the uploads in flight are waited for, then the input and the
+# outputs are removed
+def abandon_separation(state):
+   async def cleanup():
+      file_path = state.get("file_path")
+      paths = [file_path] if file_path else []
+      inference = state.get("inference")
+      held = state.get("held")
+      try:
+         if inference is not None:
+            if not inference.done():
+               logger.warn(f"The separation of {file_path} keeps running after the deadline, its files are removed once it is done")
+            await asyncio.gather(asyncio.wrap_future(inference), return_exceptions=True)
+            if not inference.cancelled() and inference.exception() is None:
+               paths += [APPLIO_AUDIO_OUTPUT_PATH + output for output in inference.result()]
+      finally:
+         if held is not None:
+            await held.aclose()
+
+      await asyncio.gather(*[asyncio.wrap_future(future) for future in state.get("uploads", [])], return_exceptions=True)
+      for stream in state.get("stem_streams", {}).values():
+         await asyncio.to_thread(stream.abort)
+      for path in paths:
+         try:
+            await asyncio.to_thread(remove_path, path)
+         except OSError as e:
+            logger.error(f"An error occurred while removing the file: {e}")
+
+   task = asyncio.create_task(cleanup())
+   abandoned_separation_tasks.add(task)
+   task.add_done_callback(abandoned_separation_tasks.discard)
+
+# the stages overlap: the original file is uploaded while the audio is separated
+# and the stems are uploaded as soon as the separator has written them
+async def separation_pipeline(request_body: dict, on_inference_start=None, wait_for_slot=False, background_upload=False, state=None):
+   state = state if state is not None else {}
    start_time = time.time()  # Start the timer
    logger.info("Separating the audio...\n")
    file_path = request_body.get("file_path")
    video_or_audio_url = request_body.get("video_or_audio_url")
    audio_id = request_body.get("audio_id")
    purpose = request_body.get("purpose")
+   chunked = request_body.get("chunked", False)
    
    if file_path: 
       logger.info("Reading the audio file...\n")
@@ -282,7 +662,7 @@ async def separate_audio(request_body: dict):
       # if ends with mp3, download the audio
       elif video_or_audio_url.endswith(".mp3") or video_or_audio_url.endswith(".wav"):
          logger.info(f"Downloading the audio from the URL... URL: {video_or_audio_url}\n")
-         res = await download_file(video_or_audio_url)
+         res = await fetch_input_file(video_or_audio_url, wait_for_slot)
          file_path = res["file_path"]
          logger.info(f"Audio downloaded successfully. Saved in: {file_path}\n")
 
@@ -293,38 +673,124 @@ async def separate_audio(request_body: dict):
          "error": f"Unable to download audio, URL: {video_or_audio_url}, audio_id: {audio_id}"
       }
    
+   state["file_path"] = file_path
+   loop = asyncio.get_running_loop()
+   upload = purpose is not None and purpose == "vocal_remover"
+   cache_key = None
+   cached = None
    try:
-      outputs = separator.separate(file_path)
+      cache_key = await loop.run_in_executor(None, separation_cache_key, file_path, chunked)
+      cached = await loop.run_in_executor(None, separation_cache.get, cache_key)
    except Exception as e:
-      logger.error(f"Error occurred while separating audio: {str(e)}")
-      await cleanup_files({"paths": [file_path]})
-      return {
-         "status": "error",
-         "error": f"Error occurred while separating audio: {str(e)}"
+      logger.error(f"Error occurred while reading the separation cache: {str(e)}")
+
+   # the files of this audio were already uploaded, return the earlier urls without uploading again
+   if upload and cached is not None and cached["metadata"].get("r2_vocal_file_url"):
+      outputs = await loop.run_in_executor(None, restore_cached_stems, cached)
+      response = {
+         "status": "success",
+         "vocal_file_path": APPLIO_AUDIO_OUTPUT_PATH + outputs[1],
+         "instrumental_file_path":  APPLIO_AUDIO_OUTPUT_PATH + outputs[0],
+         "original_file_path": file_path,
+         "r2_original_file_url": cached["metadata"]["r2_original_file_url"],
+         "r2_vocal_file_url": cached["metadata"]["r2_vocal_file_url"],
+         "r2_instrumental_file_url": cached["metadata"]["r2_instrumental_file_url"]
       }
-   
-   logger.info(f"Audio separated successfully. Outputs: {outputs}\n")
+
+      logger.info(f"Audio separation response from cache: {response}\n")
+
+      return response
+
+   # uploads in flight, a cancelled separation waits for them before removing the files
+   uploads = state["uploads"] = []
+
+   # Create a function to upload a file on the shared upload executor
+   def upload_local_file(file_path, file_name):
+      def upload():
+         file_upload_rs = upload_file(file_path, file_name, BucketType.CONTENT_FILES)
+         if file_upload_rs is None:
+            raise Exception(f"Failed to upload {file_name}")
+         return file_upload_rs
+      future = UPLOAD_EXECUTOR.submit(upload)
+      uploads.append(future)
+      return asyncio.wrap_future(future)
+
+   def finish_stem_stream(stem_name):
+      future = stem_streams[stem_name].submit_finish()
+      uploads.append(future)
+      return asyncio.wrap_future(future)
+
+   # the original file exists from the start, upload it while the audio is being separated
+   original_file_path = file_path
+   original_file_upload = upload_local_file(original_file_path, audio_id) if upload else None
+
+   # chunked stems are uploaded while they are written, whole parts as the windows are appended
+   stem_names = [f'{audio_id}_instrumental.mp3', f'{audio_id}_vocal.mp3']
+   stem_streams = state["stem_streams"] = {}
+   def stream_stems(index, *stem_paths):
+      for stem_path, stem_name in zip(stem_paths, stem_names):
+         if stem_name not in stem_streams:
+            stem_streams[stem_name] = ProgressiveUpload(stem_path, stem_name, BucketType.CONTENT_FILES)
+         stem_streams[stem_name].grow()
+
+   if cached is not None:
+      outputs = await loop.run_in_executor(None, restore_cached_stems, cached)
+      logger.info(f"Separation cache hit, skipping inference. Outputs: {outputs}\n")
+   else:
+      try:
+         async with contextlib.AsyncExitStack() as held:
+            # keep the janitor away from the audio while it waits for a slot and is separated
+            held.enter_context(janitor.pin(file_path))
+            await held.enter_async_context(scheduler.slot("inference", block=wait_for_slot))
+            try:
+               outputs = await run_inference(file_path, on_inference_start, chunked, stream_stems if upload else None, lambda future: state.update(inference=future))
+            except asyncio.CancelledError:
+               # the inference thread can't be stopped, it keeps the slot and the pin until it is done
+               if state.get("inference") is not None and not state["inference"].done():
+                  state["held"] = held.pop_all()
+               raise
+      except Overloaded:
+         if original_file_upload is not None:
+            await asyncio.gather(original_file_upload, return_exceptions=True)
+         await cleanup_files({"paths": [file_path]})
+         raise
+      except Exception as e:
+         logger.error(f"Error occurred while separating audio: {str(e)}")
+         for stream in stem_streams.values():
+            await loop.run_in_executor(None, stream.abort)
+         # don't remove the file while it's still being uploaded
+         if original_file_upload is not None:
+            await asyncio.gather(original_file_upload, return_exceptions=True)
+         await cleanup_files({"paths": [file_path]})
+         return {
+            "status": "error",
+            "error": f"Error occurred while separating audio: {str(e)}"
+         }
+
+      logger.info(f"Audio separated successfully. Outputs: {outputs}\n")
    
    instrumental_file_path =  APPLIO_AUDIO_OUTPUT_PATH + outputs[0]
    vocal_file_path =  APPLIO_AUDIO_OUTPUT_PATH + outputs[1]
-   original_file_path = file_path
-   
-   # Create a function to upload a file
-   def upload_local_file(file_path, file_name):
-      file_upload_rs = upload_file(file_path, file_name, BucketType.CONTENT_FILES)
-      if file_upload_rs is None:
-         raise Exception(f"Failed to upload {file_name}")
-      return file_upload_rs
 
-   # Create a list of paths and file names
-   upload_paths = []
-   file_names = []
-   if purpose is not None and purpose == "vocal_remover":
-      upload_paths = [original_file_path, instrumental_file_path, vocal_file_path]
-      file_names = [audio_id, f'{audio_id}_instrumental.mp3', f'{audio_id}_vocal.mp3']
+   # the stems are final once the separator returns, start their uploads right away
+   # and store them in the cache while they are being uploaded
+   stem_uploads = []
+   if upload:
+      logger.info("Uploading the audio files to R2...\n")
+      stem_uploads = [
+         # the parts streamed during a chunked separation only need the rest of the file and the header
+         finish_stem_stream(stem_name) if stem_name in stem_streams else upload_local_file(stem_path, stem_name)
+         for stem_path, stem_name in zip([instrumental_file_path, vocal_file_path], stem_names)
+      ]
+
+   if cached is None and cache_key is not None:
+      try:
+         await loop.run_in_executor(None, store_separation_in_cache, cache_key, outputs)
+      except Exception as e:
+         logger.error(f"Error occurred while storing the separation in the cache: {str(e)}")
 
    # check if there are any files to upload, if not return the response
-   if len(upload_paths) == 0:
+   if not upload:
       
       logger.info(f"No files to upload. Purpose: {purpose}\n")
       
@@ -339,25 +805,52 @@ async def separate_audio(request_body: dict):
       
       return response
 
-   # Use concurrent.futures to upload files in parallel
-   with concurrent.futures.ThreadPoolExecutor() as executor:
-         
-      # Submit the upload tasks
-      upload_tasks = [executor.submit(upload_local_file, file_path, file_name) for file_path, file_name in zip(upload_paths, file_names)]
-      
-      # Wait for all tasks to complete
-      concurrent.futures.wait(upload_tasks)
-      
-      # Get the results of the upload tasks
-      results = [task.result() for task in upload_tasks]
-      
-      # Check if any upload failed
-      if None in results:
-         raise Exception("Failed to upload audio files")
-      
-      original_file_upload_rs, instrumental_file_upload_rs, vocal_file_upload_rs = results
+   # remember the urls so the next request for the same audio doesn't upload again
+   def record_uploads(original_file_upload_rs, instrumental_file_upload_rs, vocal_file_upload_rs):
+      if cache_key is None:
+         return
+      try:
+         separation_cache.update_metadata(
+            cache_key,
+            r2_original_file_url=original_file_upload_rs,
+            r2_vocal_file_url=vocal_file_upload_rs,
+            r2_instrumental_file_url=instrumental_file_upload_rs
+         )
+      except Exception as e:
+         logger.error(f"Error occurred while storing the upload urls in the separation cache: {str(e)}")
+
+   # respond right away with the urls the files will have, the uploads are recorded once they are all done
+   if background_upload:
+      async def finish_uploads():
+         with janitor.pin(original_file_path, instrumental_file_path, vocal_file_path):
+            results = await asyncio.gather(original_file_upload, *stem_uploads, return_exceptions=True)
+         failed = [result for result in results if result is None or isinstance(result, BaseException)]
+         if failed:
+            logger.error(f"Background upload of the separated audio failed, audio_id: {audio_id}, error: {failed[0]}")
+            return
+         logger.info(f"Separated audio uploaded to R2 in the background, audio_id: {audio_id}")
+         await loop.run_in_executor(None, record_uploads, *results)
+
+      task = asyncio.create_task(finish_uploads())
+      background_upload_tasks.add(task)
+      task.add_done_callback(background_upload_tasks.discard)
+      return {
+         "status": "success",
+         "vocal_file_path": vocal_file_path,
+         "instrumental_file_path":  instrumental_file_path,
+         "original_file_path": original_file_path,
+         "r2_original_file_url": content_file_url(audio_id),
+         "r2_vocal_file_url": content_file_url(stem_names[1]),
+         "r2_instrumental_file_url": content_file_url(stem_names[0])
+      }
+
+   results = await asyncio.gather(original_file_upload, *stem_uploads)
    
-   logger.info("Uploading the audio files to R2...\n")
+   # Check if any upload failed
+   if None in results:
+      raise Exception("Failed to upload audio files")
+   
+   original_file_upload_rs, instrumental_file_upload_rs, vocal_file_upload_rs = results
    
    end_time = time.time()  # Stop the timer
    elapsed_time = end_time - start_time  # Calculate the elapsed time
@@ -374,36 +867,69 @@ async def separate_audio(request_body: dict):
       "r2_instrumental_file_url": instrumental_file_upload_rs
    }
 
+   await loop.run_in_executor(None, record_uploads, original_file_upload_rs, instrumental_file_upload_rs, vocal_file_upload_rs)
+
    logger.info(f"Audio separation response: {response}\n")
 
    return response
    
+# merge the stems with pydub, used for stems the numpy mixer can't read
+def merge_with_pydub(stem_file_paths, merged_audio_path, gains=None):
+   stems = [AudioSegment.from_file(path) for path in stem_file_paths]
+
+   # Ensure that the audio files have the same duration
+   min_duration = min(len(stem) for stem in stems)
+   stems = [stem[:min_duration] for stem in stems]
+
+   # apply the linear gains as dB
+   if gains:
+      stems = [stem.apply_gain(20 * math.log10(gain)) if gain > 0 else stem - 120 for stem, gain in zip(stems, gains)]
+
+   # Combine the audio files
+   merged_audio = stems[0]
+   for stem in stems[1:]:
+      merged_audio = merged_audio.overlay(stem)
+
+   merged_audio.export(merged_audio_path, format="mp3")
+
+# with "delivery": "stream" the merged audio is sent in the response body instead of waiting for the R2 upload
 @app.post("/merge_audio")
-async def merge_audio(request_body: dict):
+async def merge_audio(request_body: dict, request: Request):
+   scheduler.check("encoding")
    logger.info("Merging the audio...")
    vocal_file_path = request_body.get("vocal_file_path")
    instrumental_file_path = request_body.get("instrumental_file_path")
    audio_id = request_body.get("audio_id")
-   vocal_audio = AudioSegment.from_wav(vocal_file_path)
-   instrumental_audio = AudioSegment.from_wav(instrumental_file_path)
-
-   # Ensure that the audio files have the same duration
-   min_duration = min(len(vocal_audio), len(instrumental_audio))
-   vocal_audio = vocal_audio[:min_duration]
-   instrumental_audio = instrumental_audio[:min_duration]
+   # any number of stems can be mixed, by default the vocal and the instrumental
+   stem_file_paths = request_body.get("stem_file_paths") or [vocal_file_path, instrumental_file_path]
+   gains = request_body.get("gains")
+   clip = request_body.get("clip", "hard")
 
-   # Combine the audio files
-   merged_audio = vocal_audio.overlay(instrumental_audio)
-
-   vocal_file_name = vocal_file_path.split('/')[-1].split('.')[0]
+   vocal_file_name = stem_file_paths[0].split('/')[-1].split('.')[0]
 
    # Save the merged audio
    merged_audio_path = f'{APPLIO_AUDIO_OUTPUT_PATH}{vocal_file_name}_merged.mp3'
-   merged_audio.export(merged_audio_path, format="mp3")
+
+   # mix the memory mapped wavs block by block and stream the result into the encoder
+   loop = asyncio.get_running_loop()
+   with janitor.pin(*stem_file_paths, merged_audio_path):
+      async with scheduler.slot("encoding"):
+         try:
+            await loop.run_in_executor(None, lambda: mix_wav_files(stem_file_paths, merged_audio_path, gains, clip))
+         except ValueError as e:
+            logger.warn(f"Unable to mix the stems with numpy, falling back to pydub: {str(e)}")
+            await loop.run_in_executor(None, merge_with_pydub, stem_file_paths, merged_audio_path, gains)
 
    logger.info("Audio merged successfully.")
+
+   # send the merged audio in the response body, the R2 upload runs in the background
+   if request_body.get("delivery") == "stream":
+      headers = {}
+      if request_body.get("r2_upload", True):
+         headers["X-R2-Merged-Audio-Url"] = upload_in_background(merged_audio_path, audio_id)
+      return stream_output_file(request, merged_audio_path, headers)
    
-   file_upload_rs = upload_file(merged_audio_path, audio_id, BucketType.CONTENT_FILES)
+   file_upload_rs = await asyncio.wrap_future(submit_upload(merged_audio_path, audio_id, BucketType.CONTENT_FILES))
    
    if file_upload_rs is None:
       raise Exception("Failed to upload the merged audio file.")
@@ -419,35 +945,19 @@ async def merge_audio(request_body: dict):
 @app.get("/get_model_files")
 async def get_model_files(model_id: str):
    logger.info(f"Getting model files for model id: {model_id}")
-   # find file that contains the model_id and ends with .pth in the APPLIO_LOGS_PATH
-   model_file_path = None
-   model_name = None
-   index_file_path = None
-   index_file_name = None
-
-   for file in os.listdir(APPLIO_LOGS_PATH):
-      if model_id in file and file.endswith(".pth"):
-         model_file_path = os.path.join(APPLIO_LOGS_DIR, file)
-         model_name = file
-         break
-
-   # Find the folder named as model id in APPLIO_LOGS_PATH
-   for folder in os.listdir(APPLIO_LOGS_PATH):
-      if os.path.isdir(os.path.join(APPLIO_LOGS_PATH, folder)) and model_id in folder:
-         # Find the file that starts with "added" and ends with .index inside the folder
-         for file in os.listdir(os.path.join(APPLIO_LOGS_PATH, folder)):
-            if (file.startswith("added") or model_id in file) and file.endswith(".index"):
-               index_file_path = os.path.join(APPLIO_LOGS_DIR, folder, file)
-               index_file_name = file
-            elif model_file_path is None and model_name is None and model_id in file and file.endswith(".pth"):
-               model_file_path = os.path.join(APPLIO_LOGS_DIR, folder, file)
-               model_name = file
-
+   # find file that contains the model_id and ends with .pth in the APPLIO_LOGS_PATH, and the index
+   # file in the folder named as model id. the listings are kept in memory and only read again when
+   # the folders change. a changed folder is listed again, so the lookup runs off the event loop
+   return await asyncio.get_running_loop().run_in_executor(None, model_index.lookup, model_id)
+
+# get the model files of many model ids in one call, returns model id -> same payload as /get_model_files
+@app.post("/get_model_files_batch")
+async def get_model_files_batch(request_body: dict):
+   model_ids = request_body.get("model_ids") or []
+   logger.info(f"Getting model files for {len(model_ids)} model ids")
+   models = await asyncio.get_running_loop().run_in_executor(None, lambda: {model_id: model_index.lookup(model_id) for model_id in model_ids})
    return {
-      "model_file_path": model_file_path,
-      "model_file_name": model_name,
-      "index_file_path": index_file_path,
-      "index_file_name": index_file_name
+      "models": models
    }
    
 # write an API that would take a list of file paths and remove them for cleanup
@@ -460,11 +970,9 @@ async def cleanup_files(request_body: dict):
       if APPLIO_ROOT_PATH not in path:
          updated_path = APPLIO_ROOT_PATH + path
       
+      # removing a folder can take a while, keep it off the event loop
       try:
-         if os.path.isfile(updated_path):
-           os.remove(updated_path)
-         elif os.path.isdir(updated_path):
-           shutil.rmtree(updated_path)
+         await asyncio.to_thread(remove_path, updated_path)
       except Exception as e:
          logger.error(f"An error occurred while removing the file: {e}")
          continue
@@ -485,6 +993,7 @@ async def make_index_file_name_unique(request_body: dict):
    new_index_file_name = index_file_name.replace(".index", f"_vox_{model_id}.index") # create a unique index file name to avoid file from being overwritten in R2       
    new_index_file_path = os.path.join(os.path.dirname(full_index_file_path), new_index_file_name)
    os.rename(full_index_file_path, new_index_file_path)
+   model_index.invalidate(os.path.dirname(full_index_file_path))
    short_new_index_file_path = new_index_file_path.split(APPLIO_ROOT_PATH)[1]
    return {
       "model_file_path": model_file_path,
@@ -516,20 +1025,13 @@ async def upload_model_files(request_body: dict):
    file_names = [model_file_name, index_file_name]
    bucket_types = [BucketType.PTH_FILES, BucketType.INDEX_FILES]
 
-   # Use concurrent.futures to upload files in parallel
-   with concurrent.futures.ThreadPoolExecutor() as executor:
-      # Submit the upload tasks
-      upload_tasks = [executor.submit(upload_local_file, file_path, file_name, bucket_type) for file_path, file_name, bucket_type in zip(upload_paths, file_names, bucket_types)]
-      
-      # Wait for all tasks to complete
-      concurrent.futures.wait(upload_tasks)
-      
-      # Get the results of the upload tasks
-      results = [task.result() for task in upload_tasks]
-      
-      # Check if any upload failed
-      if None in results:
-         raise Exception("Failed to upload model files")
+   # Upload the files in parallel on the shared upload executor
+   upload_tasks = [asyncio.wrap_future(UPLOAD_EXECUTOR.submit(upload_local_file, file_path, file_name, bucket_type)) for file_path, file_name, bucket_type in zip(upload_paths, file_names, bucket_types)]
+   results = await asyncio.gather(*upload_tasks)
+   
+   # Check if any upload failed
+   if None in results:
+      raise Exception("Failed to upload model files")
 
    return {
       "message": "Model and index files uploaded successfully.",
@@ -558,30 +1060,23 @@ async def upload_files_to_r2(request_body: dict):
          "r2_url": file_upload_rs
       }
 
-   # Use concurrent.futures to upload files in parallel
-   with concurrent.futures.ThreadPoolExecutor() as executor:
-      # Submit the upload tasks
-      # paths is a dictionary with keys as file paths and values as file names
-      upload_tasks = [executor.submit(upload_local_file, file_path, file_name) for file_path, file_name in paths.items()]
-      
-      # Wait for all tasks to complete
-      concurrent.futures.wait(upload_tasks)
-      
-      # Get the results of the upload tasks
-      results = [task.result() for task in upload_tasks]
-      
-      # make the results as a dictionary
-      results = {result["file_path"]: result["r2_url"] for result in results}
-      
-      logger.info(f"Files uploaded successfully to R2, results: {results}")
-      
-      # Check if any upload failed
-      if None in results:
-         logger.error("Failed to upload files, paths: {paths}, bucket_type: {bucket_type}")
-         return {
-            "status": "error",
-            "error": "Failed to upload files"
-         }
+   # Upload the files in parallel on the shared upload executor
+   # paths is a dictionary with keys as file paths and values as file names
+   upload_tasks = [asyncio.wrap_future(UPLOAD_EXECUTOR.submit(upload_local_file, file_path, file_name)) for file_path, file_name in paths.items()]
+   results = await asyncio.gather(*upload_tasks)
+   
+   # make the results as a dictionary
+   results = {result["file_path"]: result["r2_url"] for result in results}
+   
+   logger.info(f"Files uploaded successfully to R2, results: {results}")
+   
+   # Check if any upload failed
+   if None in results:
+      logger.error("Failed to upload files, paths: {paths}, bucket_type: {bucket_type}")
+      return {
+         "status": "error",
+         "error": "Failed to upload files"
+      }
 
    return {
       "status": "success",
@@ -590,6 +1085,7 @@ async def upload_files_to_r2(request_body: dict):
    
 @app.post("/generate_video")
 async def generate_video(request_body: dict): 
+   scheduler.check("encoding")
    logger.info("Generating the video...")
    audio_url = request_body.get("audio_url")
    audio_data = request_body.get("audio_data")
@@ -611,7 +1107,12 @@ async def generate_video(request_body: dict):
       with open(audio_file_path, "wb") as f:
          f.write(base64.b64decode(audio_data))
       logger.info(f"Audio data saved successfully. Saved in: {audio_file_path}\n")
-   
+
+   return await create_cover_video(audio_file_path, cover_image_url, audio_id)
+
+# render the audio over the still cover image, upload the video and remove the request files.
+# audio_file_path is the audio of the request, already on disk
+async def create_cover_video(audio_file_path, cover_image_url, audio_id):
    # download the cover image if cover_image_url is provided
    if cover_image_url:
       logger.info(f"Downloading the cover image from the URL... URL: {cover_image_url}\n")
@@ -631,15 +1132,34 @@ async def generate_video(request_body: dict):
    video_key = f"{clean_audio_id}_{short_rand_string}.mp4"
    video_path = f'{APPLIO_AUDIO_OUTPUT_PATH}{video_key}'
 
-   # get the duration of the audio in seconds
-   audio = AudioSegment.from_file(audio_file_path)
-   audio_duration = len(audio) / 1000
+   # return the video rendered earlier for the same audio and cover
+   loop = asyncio.get_running_loop()
+   cache_key = await loop.run_in_executor(None, video_cache_key, "cover", audio_file_path, cover_image_path, None)
+   cached = await loop.run_in_executor(None, video_cache.get, cache_key)
+   if cached is not None:
+      logger.info(f"Found the video in the cache. URL: {cached['metadata']['r2_video_url']}")
+      await cleanup_files({"paths": [audio_file_path, cover_image_path]})
+      return {
+         "status": "success",
+         "r2_video_url": cached["metadata"]["r2_video_url"],
+         "video_key": cached["metadata"]["video_key"],
+         "audio_id": audio_id
+      }
 
-   exit_code = os.system(f"ffmpeg -r 1 -loop 1 -y -t {audio_duration} -i {cover_image_path} -i {audio_file_path} -c:v h264_nvenc -shortest -pix_fmt yuv420p {video_path}")
+   # get the duration of the audio in seconds from its headers, without decoding it
+   audio_info = await loop.run_in_executor(None, probe_audio, audio_file_path)
+   audio_duration = audio_info.duration
 
-   if exit_code != 0:
+   try:
+      with janitor.pin(audio_file_path, cover_image_path, video_path):
+         async with scheduler.slot("encoding"):
+            await run_ffmpeg(["ffmpeg", "-r", "1", "-loop", "1", "-t", str(audio_duration), "-i", cover_image_path, "-i", audio_file_path, *encoder_args(), "-shortest", "-pix_fmt", "yuv420p", video_path], audio_duration)
+   except Overloaded:
+      await cleanup_files({"paths": [audio_file_path, cover_image_path]})
+      raise
+   except RenderError as e:
       await cleanup_files({"paths": [audio_file_path, cover_image_path, video_path]})
-      logger.error("Failed to generate the video.")
+      logger.error(f"Failed to generate the video. {str(e)}, ffmpeg output: {e.stderr_tail[-5:]}")
       return {
          "status": "error",
          "error": "Failed to generate the video."
@@ -647,13 +1167,18 @@ async def generate_video(request_body: dict):
    
    logger.info(f'Video generated successfully and saved in: {video_path}')
    
-   file_upload_rs = upload_file(video_path, video_key, BucketType.CONTENT_FILES)
+   file_upload_rs = await asyncio.wrap_future(submit_upload(video_path, video_key, BucketType.CONTENT_FILES))
    
    if file_upload_rs is None:
       raise Exception("Failed to upload the video file.")
    
    logger.info(f"Video uploaded successfully to R2. URL: {file_upload_rs}")
    
+   try:
+      await loop.run_in_executor(None, store_video_in_cache, cache_key, video_path, file_upload_rs, video_key)
+   except Exception as e:
+      logger.error(f"Error occurred while storing the video in the cache: {str(e)}")
+   
    # cleanup the files
    await cleanup_files({"paths": [audio_file_path, cover_image_path, video_path]})
 
@@ -664,8 +1189,11 @@ async def generate_video(request_body: dict):
       "audio_id": audio_id
    }
    
+# with "delivery": "stream" the video is sent in the response body instead of waiting for the R2 upload,
+# which runs in the background unless "r2_upload" is false
 @app.post("/generate_video_new")
-async def generate_video(request_body: dict): 
+async def generate_video(request_body: dict, request: Request): 
+   scheduler.check("encoding")
    start_time = time.time()  # Start the timer
    logger.info("Generating the video...")
    audio_url = request_body.get("audio_url")
@@ -674,7 +1202,6 @@ async def generate_video(request_body: dict):
    audio_id = request_body.get("audio_id")
    
    audio_file_path = None
-   use_default_cover_image = False
    
    # download the audio if audio_url is provided
    if audio_url:
@@ -689,6 +1216,14 @@ async def generate_video(request_body: dict):
       with open(audio_file_path, "wb") as f:
          f.write(base64.b64decode(audio_data))
       logger.info(f"Audio data saved successfully. Saved in: {audio_file_path}\n")
+
+   return await create_vinyl_video(audio_file_path, cover_image_url, audio_id, start_time, request_body.get("delivery"), request, request_body.get("r2_upload", True))
+
+# render the vinyl video template, upload the video and remove the request files.
+# audio_file_path is the audio of the request, already on disk
+async def create_vinyl_video(audio_file_path, cover_image_url, audio_id, start_time=None, delivery=None, request=None, r2_upload=True):
+   start_time = start_time or time.time()
+   cover_image_path = None
    
    # download the cover image if cover_image_url is provided
    if cover_image_url:
@@ -699,11 +1234,8 @@ async def generate_video(request_body: dict):
    else:
       # pick default cover image
       logger.info("Using the default cover image...\n")
-      use_default_cover_image = True
       
-   # default cover image path and blur cover image path
    default_cover_image_path = f"{AUDIO_MANIPULATOR_VIDEO_GENERATION_PATH}default_cover_image.png"
-   default_blur_cover_path = f"{AUDIO_MANIPULATOR_VIDEO_GENERATION_PATH}default_blur_albumcover.jpg"
       
    # create a short random string using current timestamp
    short_rand_string = str(int(time.time()))
@@ -713,48 +1245,102 @@ async def generate_video(request_body: dict):
    video_key = f"{clean_audio_id}_{short_rand_string}.mp4"
    video_path = f'{APPLIO_AUDIO_OUTPUT_PATH}{video_key}'
 
-   # get the duration of the audio in seconds
-   audio = AudioSegment.from_file(audio_file_path)
-   audio_duration = len(audio) / 1000
+   # return the video rendered earlier for the same audio and cover
+   loop = asyncio.get_running_loop()
+   use_cover_image_path = cover_image_path or default_cover_image_path
+   cache_key = await loop.run_in_executor(None, video_cache_key, "vinyl", audio_file_path, use_cover_image_path, VIDEO_OUTPUT_SIZE)
+   cached = await loop.run_in_executor(None, video_cache.get, cache_key)
+   if cached is not None:
+      logger.info(f"Found the video in the cache. URL: {cached['metadata']['r2_video_url']}")
+      await cleanup_files({"paths": [path for path in [audio_file_path, cover_image_path] if path]})
+      if delivery == "stream":
+         return stream_output_file(request, cached["files"]["video.mp4"], {
+            "X-R2-Video-Url": cached["metadata"]["r2_video_url"],
+            "X-Video-Key": cached["metadata"]["video_key"]
+         })
+      return {
+         "status": "success",
+         "r2_video_url": cached["metadata"]["r2_video_url"],
+         "video_key": cached["metadata"]["video_key"],
+         "audio_id": audio_id
+      }
+
+   # get the duration of the audio in seconds from its headers, without decoding it
+   audio_info = await loop.run_in_executor(None, probe_audio, audio_file_path)
+   audio_duration = audio_info.duration
    
    audio_duration = int(audio_duration)
    
-   if cover_image_url:
-      # generate the blur background image
-      blur_cover_path = f"{APPLIO_AUDIO_OUTPUT_PATH}blur_albumcover.jpg"
-      image_exit_code = os.system(f"convert {cover_image_path} -scale 10% -blur 0x6 -scale 100% {blur_cover_path}")
+   # generate the blur background image on the thread pool, or get it from the cache
+   try:
+      use_blur_cover_path = await loop.run_in_executor(None, blurred_background, use_cover_image_path, VIDEO_OUTPUT_SIZE)
+   except Exception as e:
+      logger.error(f"Failed to blur the cover image, using the default cover image. Error: {str(e)}")
+      use_cover_image_path = default_cover_image_path
+      use_blur_cover_path = await loop.run_in_executor(None, blurred_background, use_cover_image_path, VIDEO_OUTPUT_SIZE)
 
-      if image_exit_code != 0:
-         use_default_cover_image = True
-   else:
-      use_default_cover_image = True
-   
-   use_cover_image_path = use_default_cover_image and default_cover_image_path or cover_image_path
-   use_blur_cover_path = use_default_cover_image and default_blur_cover_path or blur_cover_path
+   # the blurred background belongs to the cache, only the files of this request are removed
+   cleanup_paths = [path for path in [audio_file_path, cover_image_path, video_path] if path]
       
-   # execute the python script to generate the video
-   command = f"python3 {AUDIO_MANIPULATOR_VIDEO_GENERATION_PATH}generate_video.py --audio {audio_file_path} --cover_image {use_cover_image_path} --duration {audio_duration} --output {video_path} --background {use_blur_cover_path}"
-   video_exit_code = os.system(command)
-
-   if video_exit_code != 0:
-      await cleanup_files({"paths": [audio_file_path, cover_image_path, video_path, blur_cover_path]})
-      logger.error("Failed to generate the video.")
+   # log the render progress every 10%
+   last_logged_progress = [0]
+   def log_progress(seconds_rendered, duration):
+      progress = int(seconds_rendered / max(duration, 1) * 10) * 10
+      if progress > last_logged_progress[0]:
+         last_logged_progress[0] = progress
+         logger.info(f"Rendering video {video_key}: {progress}%")
+
+   # render the video in-process, ffmpeg runs as an asyncio subprocess
+   try:
+      with janitor.pin(*cleanup_paths):
+         async with scheduler.slot("encoding"):
+            await render_video(audio_file_path, use_cover_image_path, audio_duration, video_path, use_blur_cover_path, VIDEO_OUTPUT_SIZE, on_progress=log_progress)
+   except Overloaded:
+      await cleanup_files({"paths": cleanup_paths})
+      raise
+   except RenderError as e:
+      await cleanup_files({"paths": cleanup_paths})
+      logger.error(f"Failed to generate the video. {str(e)}, ffmpeg output: {e.stderr_tail[-5:]}")
       return {
          "status": "error",
          "error": "Failed to generate the video."
       }
    
    logger.info(f'Video generated successfully and saved in: {video_path}')
+
+   # send the video in the response body, it is removed once it is sent and uploaded in the background
+   if delivery == "stream":
+      await cleanup_files({"paths": [path for path in [audio_file_path, cover_image_path] if path]})
+      logger.info(f"Time taken for video creation: {time.time() - start_time} seconds\n")
+      def remove_video():
+         remove_path(video_path)
+      if not r2_upload:
+         return stream_output_file(request, video_path, {"X-Video-Key": video_key}, on_sent=remove_video)
+
+      done = run_after(2, remove_video)
+      def uploaded(url):
+         try:
+            if url is not None:
+               store_video_in_cache(cache_key, video_path, url, video_key)
+         finally:
+            done()
+      r2_video_url = upload_in_background(video_path, video_key, on_done=uploaded)
+      return stream_output_file(request, video_path, {"X-R2-Video-Url": r2_video_url, "X-Video-Key": video_key}, on_sent=done)
    
-   file_upload_rs = upload_file(video_path, video_key, BucketType.CONTENT_FILES)
+   file_upload_rs = await asyncio.wrap_future(submit_upload(video_path, video_key, BucketType.CONTENT_FILES))
    
    if file_upload_rs is None:
       raise Exception("Failed to upload the video file.")
    
    logger.info(f"Video uploaded successfully to R2. URL: {file_upload_rs}")
    
+   try:
+      await loop.run_in_executor(None, store_video_in_cache, cache_key, video_path, file_upload_rs, video_key)
+   except Exception as e:
+      logger.error(f"Error occurred while storing the video in the cache: {str(e)}")
+   
    # cleanup the files
-   await cleanup_files({"paths": [audio_file_path, cover_image_path, video_path, blur_cover_path]})
+   await cleanup_files({"paths": cleanup_paths})
    
    end_time = time.time()  # Stop the timer
    elapsed_time = end_time - start_time  # Calculate the elapsed time
@@ -767,6 +1353,48 @@ async def generate_video(request_body: dict):
       "video_key": video_key,
       "audio_id": audio_id
    }
+
+# save the audio streamed in the request body, either the raw file or multipart/form-data with the file in
+# the "audio" part. form fields override the query parameters. returns the audio path, audio id and cover url
+async def receive_audio_upload(request: Request, audio_id, cover_image_url):
+   audio_file_path = f"{APPLIO_AUDIO_OUTPUT_PATH}upload_{uuid.uuid4().hex}"
+   with janitor.pin(audio_file_path):
+      upload = await receive_upload(request, audio_file_path, UPLOAD_MAX_BYTES, file_field="audio")
+   logger.info(f"Audio received successfully, {upload['bytes']} bytes. Saved in: {audio_file_path}\n")
+   fields = upload["fields"]
+   return audio_file_path, fields.get("audio_id", audio_id), fields.get("cover_image_url", cover_image_url)
+
+# same as /generate_video with the audio streamed to disk as it arrives instead of base64 in a json body
+@app.post("/generate_video_stream")
+async def generate_video_stream(request: Request, audio_id: Union[str, None] = None, cover_image_url: Union[str, None] = None):
+   scheduler.check("encoding")
+   logger.info("Generating the video...")
+   audio_file_path, audio_id, cover_image_url = await receive_audio_upload(request, audio_id, cover_image_url)
+   if not audio_id:
+      await cleanup_files({"paths": [audio_file_path]})
+      return {
+         "status": "error",
+         "error": "audio_id is required."
+      }
+
+   return await create_cover_video(audio_file_path, cover_image_url, audio_id)
+
+# same as /generate_video_new with the audio streamed to disk as it arrives instead of base64 in a json body,
+# delivery and r2_upload are query parameters
+@app.post("/generate_video_new_stream")
+async def generate_video_new_stream(request: Request, audio_id: Union[str, None] = None, cover_image_url: Union[str, None] = None, delivery: Union[str, None] = None, r2_upload: bool = True):
+   scheduler.check("encoding")
+   start_time = time.time()
+   logger.info("Generating the video...")
+   audio_file_path, audio_id, cover_image_url = await receive_audio_upload(request, audio_id, cover_image_url)
+   if not audio_id:
+      await cleanup_files({"paths": [audio_file_path]})
+      return {
+         "status": "error",
+         "error": "audio_id is required."
+      }
+
+   return await create_vinyl_video(audio_file_path, cover_image_url, audio_id, start_time, delivery, request, r2_upload)
       
    
 FastAPIInstrumentor.instrument_app(app=app, meter_provider=meter_provider, tracer_provider=tracer)
\ No newline at end of file
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+# directory mtimes have a coarse resolution, a listing taken right after a change could miss
+# another change in the same tick so it is only trusted once the directory has been still this long
+SETTLE_NS = 1000 * 1000 * 1000
+# lookup results kept in memory, they are all dropped once there are more
+MAX_RESULTS = 10000
+
+# in-memory index of the model files in the logs folder. directory listings are kept with their mtime
+# and only read again when the directory changed, lookup results are kept per model id together with
+# the mtimes they were computed from. a lookup on an unchanged folder costs a few stats instead of
+# listing the whole logs folder
+class ModelIndex:
+  def __init__(self, logs_path, path_prefix):
+    self.logs_path = logs_path
+    # the returned paths are relative to the server root, e.g. "logs/"
+    self.path_prefix = path_prefix
+    self._lock = threading.Lock()
+    # directory path -> (mtime_ns, listed_at_ns, [(name, is_dir)])
+    self._listings = {}
+    # model id -> (root and folder mtimes the result depends on, result)
+    self._results = {}
+
+  # list a directory, from memory when it didn't change since it was last listed
+  def _listing(self, path):
+    mtime_ns = os.stat(path).st_mtime_ns
+    cached = self._listings.get(path)
+    if cached is not None and cached[0] == mtime_ns and cached[1] - mtime_ns > SETTLE_NS:
+      return mtime_ns, cached[2]
+
+    listed_at_ns = time.time_ns()
+    with os.scandir(path) as entries:
+      listing = [(entry.name, entry.is_dir()) for entry in entries]
+    self._listings[path] = (mtime_ns, listed_at_ns, listing)
+    return mtime_ns, listing
+
+  def _is_current(self, mtimes):
+    try:
+      return all(os.stat(path).st_mtime_ns == mtime_ns and self._listings.get(path, (None, 0))[1] - mtime_ns > SETTLE_NS for path, mtime_ns in mtimes.items())
+    except FileNotFoundError:
+      return False
+
+  # read the logs folder and its model folders, called at startup so the first lookups are fast
+  def refresh(self):
+    with self._lock:
+      _, listing = self._listing(self.logs_path)
+      for name, is_dir in listing:
+        if is_dir:
+          self._listing(os.path.join(self.logs_path, name))
+
+  # forget what is known about a folder, e.g. after renaming a file in it
+  def invalidate(self, path=None):
+    with self._lock:
+      if path is None:
+        self._listings.clear()
+      else:
+        self._listings.pop(path.rstrip("/"), None)
+        self._listings.pop(self.logs_path, None)
+      self._results.clear()
+
+  # same matching as a scan of the logs folder: the first .pth file in the logs folder with the model id in
+  # its name, and in every folder with the model id in its name the last .index file starting with "added"
+  # or containing the model id, and the first matching .pth file when none was found in the logs folder
+  def lookup(self, model_id):
+    with self._lock:
+      cached = self._results.get(model_id)
+      if cached is not None and self._is_current(cached[0]):
+        return dict(cached[1])
+
+      root_mtime_ns, listing = self._listing(self.logs_path)
+      mtimes = {self.logs_path: root_mtime_ns}
+      model_file_path = None
+      model_name = None
+      index_file_path = None
+      index_file_name = None
+
+      for name, is_dir in listing:
+        if model_id in name and name.endswith(".pth"):
+          model_file_path = os.path.join(self.path_prefix, name)
+          model_name = name
+          break
+
+      for folder, is_dir in listing:
+        if not is_dir or model_id not in folder:
+          continue
+        folder_path = os.path.join(self.logs_path, folder)
+        mtimes[folder_path], files = self._listing(folder_path)
+        for file, _ in files:
+          if (file.startswith("added") or model_id in file) and file.endswith(".index"):
+            index_file_path = os.path.join(self.path_prefix, folder, file)
+            index_file_name = file
+          elif model_file_path is None and model_name is None and model_id in file and file.endswith(".pth"):
+            model_file_path = os.path.join(self.path_prefix, folder, file)
+            model_name = file
+
+      result = {
+        "model_file_path": model_file_path,
+        "model_file_name": model_name,
+        "index_file_path": index_file_path,
+        "index_file_name": index_file_name
+      }
+      if len(self._results) >= MAX_RESULTS:
+        self._results.clear()
+      self._results[model_id] = (mtimes, result)
+      return dict(result)
@@ -0,0 +1,92 @@
+import asyncio
+import os
+import httpx
+from httpClient import get_client, host_limit, backoff, download_to_file, MAX_RETRIES, DOWNLOAD_CHUNK_SIZE
+
+RANGED_DOWNLOAD_PARTS = 8
+# files smaller than two parts are not worth splitting
+MIN_PART_SIZE = 8 * 1024 * 1024
+
+# ask for the first byte only, a 206 with a Content-Range total means the server supports ranges.
+# a GET is used instead of a HEAD because presigned urls are often only signed for GET
+async def probe_range_support(url):
+  async with host_limit(url):
+    async with get_client().stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+      if response.status_code != 206:
+        return None
+      total_size = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+      return int(total_size) if total_size.isdigit() else None
+
+# download the url with several byte ranges in parallel, written in place into a preallocated file.
+# falls back to a single stream when the server doesn't support ranges or the file is small
+async def download_ranged(url, file_path, parts=RANGED_DOWNLOAD_PARTS):
+  try:
+    total_size = await probe_range_support(url)
+  except httpx.HTTPError:
+    total_size = None
+
+  if total_size is None or total_size < 2 * MIN_PART_SIZE or parts < 2:
+    return await download_to_file(url, file_path)
+
+  parts = min(parts, total_size // MIN_PART_SIZE)
+  part_size = -(-total_size // parts)
+
+  os.makedirs(os.path.dirname(file_path), exist_ok=True)
+  fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+  tasks = []
+  try:
+    os.ftruncate(fd, total_size)
+    tasks = [
+      asyncio.create_task(_download_range(url, fd, start, min(start + part_size, total_size) - 1))
+      for start in range(0, total_size, part_size)
+    ]
+    await asyncio.gather(*tasks)
+  except BaseException:
+    # the other ranges must have stopped writing before the fd is closed, its number could be reused by another file
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    os.close(fd)
+    os.remove(file_path)
+    raise
+  os.close(fd)
+  return file_path
+
+# write the whole chunk at offset, pwrite can write less than asked
+def _pwrite_all(fd, data, offset):
+  view = memoryview(data)
+  while view:
+    written = os.pwrite(fd, view, offset)
+    view = view[written:]
+    offset += written
+
+# write on a thread. a cancelled range still waits for the write in progress, the thread can't be stopped
+# and the fd must not be closed under it
+async def _write_at(fd, data, offset):
+  write = asyncio.ensure_future(asyncio.to_thread(_pwrite_all, fd, data, offset))
+  try:
+    await asyncio.shield(write)
+  except asyncio.CancelledError:
+    await asyncio.gather(write, return_exceptions=True)
+    raise
+
+# download bytes start..end (inclusive) and write them at their position in the file,
+# a retry resumes from the last byte written
+async def _download_range(url, fd, start, end):
+  offset = start
+  for attempt in range(MAX_RETRIES):
+    try:
+      async with host_limit(url):
+        async with get_client().stream("GET", url, headers={"Range": f"bytes={offset}-{end}"}) as response:
+          if response.status_code != 206:
+            raise httpx.HTTPStatusError(f"Expected a partial response, got {response.status_code}", request=response.request, response=response)
+          async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            await _write_at(fd, chunk, offset)
+            offset += len(chunk)
+      if offset > end:
+        return
+    except httpx.TransportError:
+      if attempt == MAX_RETRIES - 1:
+        raise
+    await backoff(attempt)
+  raise Exception(f"Failed to download bytes {start}-{end} of {url}")
@@ -0,0 +1,155 @@
+import asyncio
+import contextlib
+import fcntl
+import math
+import os
+import time
+from opentelemetry.metrics import Observation
+
+# how often a queued request checks for a free slot
+POLL_INTERVAL_SECONDS = 0.05
+# suggested retry delay before a pool has measured how long its work takes
+DEFAULT_RETRY_AFTER_SECONDS = 5
+
+# raised when a pool has no free slot and its wait queue is full, retry_after is in seconds
+class Overloaded(Exception):
+  def __init__(self, pool, retry_after):
+    super().__init__(f"The node is overloaded, no capacity left for {pool} work")
+    self.pool = pool
+    self.retry_after = retry_after
+
+# node wide pool of slots shared by every worker process. every slot and every place in the wait queue
+# is a lock file, holding its flock means holding the slot. the kernel releases the locks of a worker
+# that dies, so a crashed worker can never leak capacity
+class SlotPool:
+  def __init__(self, pool_dir, name, slots, queue_size):
+    os.makedirs(pool_dir, exist_ok=True)
+    self.name = name
+    self.slots = slots
+    self.queue_size = queue_size
+    self.slot_paths = [os.path.join(pool_dir, f"slot_{i}.lock") for i in range(slots)]
+    self.queue_paths = [os.path.join(pool_dir, f"queue_{i}.lock") for i in range(queue_size)]
+    # moving average of how long the slots are held in this worker, used for Retry-After
+    self.average_hold_seconds = None
+
+  # lock the first free file, returns its fd or None when they are all held
+  def _try_lock(self, paths):
+    for path in paths:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+      except BlockingIOError:
+        os.close(fd)
+    return None
+
+  # number of held files. a file is probed by locking it for an instant, only used for status and metrics
+  def _count_held(self, paths):
+    held = 0
+    for path in paths:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+      except BlockingIOError:
+        held += 1
+      finally:
+        os.close(fd)
+    return held
+
+  def active(self):
+    return self._count_held(self.slot_paths)
+
+  def queued(self):
+    return self._count_held(self.queue_paths)
+
+  # seconds until the queue has likely drained enough to accept new work
+  def retry_after(self):
+    average = self.average_hold_seconds or DEFAULT_RETRY_AFTER_SECONDS
+    return max(1, math.ceil(average * (self.queue_size + self.slots) / self.slots))
+
+  # raise Overloaded if new work would be rejected right now, to reject a request before doing any work for it
+  def check(self):
+    if self.active() < self.slots or self.queued() < self.queue_size:
+      return
+    raise Overloaded(self.name, self.retry_after())
+
+  # hold a slot for the duration of the block. when all the slots are taken a place in the wait queue
+  # is held while waiting, and when the queue is full as well Overloaded is raised right away, or with
+  # block set it waits for a slot or a place in the queue (for work that was already accepted).
+  # on_wait(seconds) is called with the time spent waiting for the slot
+  @contextlib.asynccontextmanager
+  async def slot(self, on_wait=None, block=False):
+    start_time = time.monotonic()
+    fd = self._try_lock(self.slot_paths)
+    if fd is None:
+      queue_fd = self._try_lock(self.queue_paths)
+      while queue_fd is None:
+        if not block:
+          raise Overloaded(self.name, self.retry_after())
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+        fd = self._try_lock(self.slot_paths)
+        if fd is not None:
+          break
+        queue_fd = self._try_lock(self.queue_paths)
+    if fd is None:
+      try:
+        while fd is None:
+          await asyncio.sleep(POLL_INTERVAL_SECONDS)
+          fd = self._try_lock(self.slot_paths)
+      finally:
+        os.close(queue_fd)
+
+    acquired_time = time.monotonic()
+    if on_wait is not None:
+      on_wait(acquired_time - start_time)
+
+    try:
+      yield
+    finally:
+      # closing the fd releases the flock
+      os.close(fd)
+      held_seconds = time.monotonic() - acquired_time
+      self.average_hold_seconds = held_seconds if self.average_hold_seconds is None else 0.8 * self.average_hold_seconds + 0.2 * held_seconds
+
+# admission control for the node: one SlotPool per kind of work (e.g. inference, encoding, io),
+# pools is a dict of pool name -> (slots, queue size). wait times and queue depths are reported
+# to the meter when one is given
+class Scheduler:
+  def __init__(self, scheduler_dir, pools, meter=None):
+    self.pools = {
+      name: SlotPool(os.path.join(scheduler_dir, name), name, slots, queue_size)
+      for name, (slots, queue_size) in pools.items()
+    }
+    self.wait_time = None
+    if meter is not None:
+      self.wait_time = meter.create_histogram("scheduler.wait_time", unit="s", description="Time spent waiting for a slot")
+      meter.create_observable_gauge("scheduler.queue_depth", callbacks=[self._observe_queue_depth], description="Requests waiting for a slot")
+      meter.create_observable_gauge("scheduler.active", callbacks=[self._observe_active], description="Slots in use")
+
+  def _observe_queue_depth(self, options):
+    return [Observation(pool.queued(), {"pool": name}) for name, pool in self.pools.items()]
+
+  def _observe_active(self, options):
+    return [Observation(pool.active(), {"pool": name}) for name, pool in self.pools.items()]
+
+  def slot(self, name, block=False):
+    def record_wait(seconds):
+      if self.wait_time is not None:
+        self.wait_time.record(seconds, {"pool": name})
+    return self.pools[name].slot(record_wait, block)
+
+  def check(self, name):
+    self.pools[name].check()
+
+  def status(self):
+    return {
+      name: {
+        "slots": pool.slots,
+        "active": pool.active(),
+        "queue_size": pool.queue_size,
+        "queued": pool.queued(),
+        "retry_after": pool.retry_after(),
+      }
+      for name, pool in self.pools.items()
+    }
@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger("AudioManipulator")
+
+# files younger than this are never evicted, even over the disk budget, they are likely still being written
+MIN_AGE_SECONDS = 5 * 60
+
+def remove_path(path):
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  elif os.path.lexists(path):
+    os.remove(path)
+
+def _path_size(path):
+  if not os.path.isdir(path) or os.path.islink(path):
+    return os.lstat(path).st_size
+  size = 0
+  for dir_path, _, files in os.walk(path):
+    for name in files:
+      try:
+        size += os.lstat(os.path.join(dir_path, name)).st_size
+      except FileNotFoundError:
+        continue
+  return size
+
+# background cleanup of the scratch folders shared by the workers of the node. entries older than the
+# ttl of their folder are deleted, then the oldest entries until everything fits in max_bytes.
+# one worker at a time sweeps, whichever holds the flock of the leader lock file.
+# files used by an in-flight request are pinned: a shared flock on a pin file per path, which the
+# sweep has to lock exclusively before deleting the path, so pinned files are skipped
+class ScratchJanitor:
+  # roots is a dict of folder -> ttl in seconds of its entries
+  def __init__(self, roots, state_dir, max_bytes, interval_seconds=60):
+    self.roots = roots
+    self.max_bytes = max_bytes
+    self.interval_seconds = interval_seconds
+    self.pins_dir = os.path.join(state_dir, "pins")
+    self.leader_lock_path = os.path.join(state_dir, "leader.lock")
+    os.makedirs(self.pins_dir, exist_ok=True)
+    self._leader_fd = None
+    # path -> [fd, count] of the pins held by this process
+    self._pins = {}
+    self._pins_lock = threading.Lock()
+    self._task = None
+
+  def _pin_path(self, path):
+    return os.path.join(self.pins_dir, hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest() + ".pin")
+
+  # open and lock the pin file, retried when the sweep removed the pin file in the meantime
+  def _lock_pin_file(self, pin_path, operation):
+    while True:
+      fd = os.open(pin_path, os.O_RDWR | os.O_CREAT, 0o644)
+      try:
+        fcntl.flock(fd, operation)
+        if os.path.exists(pin_path) and os.stat(pin_path).st_ino == os.fstat(fd).st_ino:
+          return fd
+      except BaseException:
+        os.close(fd)
+        raise
+      os.close(fd)
+
+  # keep the paths from being deleted by the sweep while the block runs, the paths don't have to exist yet.
+  # pins are counted, a path pinned twice in this process is released with the last pin
+  @contextlib.contextmanager
+  def pin(self, *paths):
+    paths = [os.path.abspath(path) for path in paths if path]
+    with self._pins_lock:
+      for path in paths:
+        if path in self._pins:
+          self._pins[path][1] += 1
+        else:
+          self._pins[path] = [self._lock_pin_file(self._pin_path(path), fcntl.LOCK_SH), 1]
+    try:
+      yield
+    finally:
+      with self._pins_lock:
+        for path in paths:
+          self._pins[path][1] -= 1
+          if self._pins[path][1] == 0:
+            os.close(self._pins.pop(path)[0])
+
+  # delete the path unless it is pinned, returns whether it was deleted
+  def _delete_unpinned(self, path):
+    pin_path = self._pin_path(path)
+    fd = os.open(pin_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return False
+      remove_path(path)
+      # nobody holds the pin, remove the pin file while it's locked so it doesn't pile up
+      os.remove(pin_path)
+      return True
+    finally:
+      os.close(fd)
+
+  # pin files of paths removed by their request are left behind, remove the ones nobody holds
+  def _remove_unused_pin_files(self):
+    for name in os.listdir(self.pins_dir):
+      pin_path = os.path.join(self.pins_dir, name)
+      try:
+        fd = os.open(pin_path, os.O_RDWR)
+      except FileNotFoundError:
+        continue
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(pin_path)
+      except (BlockingIOError, FileNotFoundError):
+        pass
+      finally:
+        os.close(fd)
+
+  # entries of the roots as (mtime, size, path, ttl)
+  def _scan(self):
+    entries = []
+    for root, ttl in self.roots.items():
+      try:
+        names = os.listdir(root)
+      except FileNotFoundError:
+        continue
+      for name in names:
+        path = os.path.join(root, name)
+        try:
+          entries.append((os.lstat(path).st_mtime, _path_size(path), path, ttl))
+        except FileNotFoundError:
+          continue
+    return entries
+
+  # delete the expired entries, then the oldest entries until the roots fit in max_bytes
+  def sweep(self):
+    now = time.time()
+    entries = sorted(self._scan())
+    total_size = sum(size for _, size, _, _ in entries)
+    deleted_files = 0
+    deleted_bytes = 0
+
+    for mtime, size, path, ttl in entries:
+      age = now - mtime
+      if age < MIN_AGE_SECONDS:
+        continue
+      if age < ttl and total_size <= self.max_bytes:
+        continue
+      try:
+        if not self._delete_unpinned(path):
+          continue
+      except OSError as e:
+        logger.error(f"Failed to remove scratch file {path}: {e}")
+        continue
+      total_size -= size
+      deleted_files += 1
+      deleted_bytes += size
+
+    self._remove_unused_pin_files()
+
+    if deleted_files:
+      logger.info(f"Removed {deleted_files} scratch files, {deleted_bytes} bytes, {total_size} bytes left")
+    return {
+      "deleted_files": deleted_files,
+      "deleted_bytes": deleted_bytes,
+      "total_bytes": total_size,
+    }
+
+  # only one worker of the node sweeps, the others keep trying in case the leader goes away
+  def _is_leader(self):
+    if self._leader_fd is not None:
+      return True
+    fd = os.open(self.leader_lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      return False
+    self._leader_fd = fd
+    return True
+
+  async def _run(self):
+    while True:
+      if self._is_leader():
+        try:
+          await asyncio.to_thread(self.sweep)
+        except Exception as e:
+          logger.error(f"Scratch cleanup failed: {e}")
+      await asyncio.sleep(self.interval_seconds)
+
+  def start(self):
+    if self._task is None:
+      self._task = asyncio.create_task(self._run())
+
+  async def stop(self):
+    if self._task is not None:
+      self._task.cancel()
+      await asyncio.gather(self._task, return_exceptions=True)
+      self._task = None
+    if self._leader_fd is not None:
+      os.close(self._leader_fd)
+      self._leader_fd = None
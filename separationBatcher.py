@@ -0,0 +1,136 @@
+import copy
+import queue
+import threading
+import time
+import torch
+
+# windows submitted by one separation, waiting to be run as part of a batch
+class _PendingWindows:
+  def __init__(self, windows):
+    self.windows = windows
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+# gathers spectrogram windows from concurrent separations and runs them through the VR model
+# as one batch, up to max_batch_size windows or until max_wait_ms has passed
+# model is set once it is built, before the first windows are submitted
+class WindowBatcher:
+  def __init__(self, model, max_batch_size=8, max_wait_ms=20):
+    self.model = model
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.pending = queue.Queue()
+    self.active_separations = 0
+    self.lock = threading.Lock()
+    # item that didn't fit in the previous batch, it starts the next one
+    self._carry = None
+    threading.Thread(target=self._run, name="window-batcher", daemon=True).start()
+
+  def begin(self):
+    with self.lock:
+      self.active_separations += 1
+
+  def end(self):
+    with self.lock:
+      self.active_separations -= 1
+
+  def predict_mask(self, windows):
+    item = _PendingWindows(windows)
+    self.pending.put(item)
+    item.done.wait()
+    if item.error is not None:
+      raise item.error
+    return item.result
+
+  def _next_batch(self):
+    first = self._carry or self.pending.get()
+    self._carry = None
+    items = [first]
+    size = len(first.windows)
+    deadline = time.monotonic() + self.max_wait
+
+    # only wait for more windows while other separations are running, a lone request is never delayed
+    while size < self.max_batch_size and len(items) < self.active_separations:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        item = self.pending.get(timeout=timeout)
+      except queue.Empty:
+        break
+      if size + len(item.windows) > self.max_batch_size:
+        self._carry = item
+        break
+      items.append(item)
+      size += len(item.windows)
+    return items
+
+  def _run(self):
+    while True:
+      items = self._next_batch()
+      try:
+        with torch.no_grad():
+          masks = self.model.predict_mask(torch.cat([item.windows for item in items]))
+        # split the batch output back per separation
+        offset = 0
+        for item in items:
+          item.result = masks[offset:offset + len(item.windows)]
+          offset += len(item.windows)
+      except Exception as e:
+        for item in items:
+          item.error = e
+      finally:
+        for item in items:
+          item.done.set()
+
+# stands in for the VR model of one separation, predict_mask goes through the shared batcher
+class _BatchedModel:
+  def __init__(self, model, batcher):
+    self._model = model
+    self._batcher = batcher
+
+  def predict_mask(self, windows):
+    return self._batcher.predict_mask(windows)
+
+  def __getattr__(self, name):
+    return getattr(self._model, name)
+
+# wraps a Separator with a loaded VR model so concurrent separate() calls share inference batches,
+# every call runs on its own shallow copy of the model instance so per file state is not shared.
+# VRSeparator.separate builds and loads the network on every call and only then runs inference_vr,
+# so batching is hooked into inference_vr of the copy: the network built by the first call is kept
+# as the shared model and every call runs its windows through it
+class BatchingSeparator:
+  thread_safe = True
+
+  def __init__(self, separator, max_batch_size=8, max_wait_ms=20):
+    if not hasattr(separator.model_instance, "inference_vr"):
+      raise ValueError("Micro-batching is only supported for VR models")
+
+    self.separator = separator
+    self.batcher = WindowBatcher(None, max_batch_size, max_wait_ms)
+    self.model_lock = threading.Lock()
+
+  def _inference_vr(self, instance, X_spec, device, aggressiveness):
+    with self.model_lock:
+      if self.batcher.model is None:
+        self.batcher.model = instance.model_run
+    instance.model_run = _BatchedModel(self.batcher.model, self.batcher)
+    return type(instance).inference_vr(instance, X_spec, device, aggressiveness)
+
+  def separate(self, file_path):
+    instance = copy.copy(self.separator.model_instance)
+    for name, value in list(vars(instance).items()):
+      if isinstance(value, dict):
+        setattr(instance, name, dict(value))
+    instance.inference_vr = lambda X_spec, device, aggressiveness: self._inference_vr(instance, X_spec, device, aggressiveness)
+
+    self.batcher.begin()
+    try:
+      return instance.separate(file_path)
+    finally:
+      self.batcher.end()
+      # same housekeeping as Separator.separate
+      instance.clear_gpu_cache()
+      instance.clear_file_specific_paths()
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+import uuid
+
+# define enum for job states reported by the status endpoint
+class JobStatus:
+  QUEUED = "queued"
+  RUNNING = "running"
+  DONE = "done"
+  ERROR = "error"
+
+# job records are stored as small json files so any gunicorn worker can answer a status request,
+# not only the worker that accepted the job
+class JobStore:
+  def __init__(self, jobs_dir):
+    self.jobs_dir = jobs_dir
+
+  def _job_path(self, job_id):
+    return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+  def create(self, request_body):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    self._write(job_id, {
+      "job_id": job_id,
+      "status": JobStatus.QUEUED,
+      "audio_id": request_body.get("audio_id"),
+      "created_at": now,
+      "updated_at": now,
+    })
+    return job_id
+
+  def get(self, job_id):
+    # job ids are generated by us, anything else can't be a valid file name
+    if not job_id.isalnum():
+      return None
+    try:
+      with open(self._job_path(job_id), "r") as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+
+  def update(self, job_id, **fields):
+    job = self.get(job_id) or {"job_id": job_id}
+    job.update(fields)
+    job["updated_at"] = time.time()
+    self._write(job_id, job)
+    return job
+
+  def _write(self, job_id, job):
+    os.makedirs(self.jobs_dir, exist_ok=True)
+    # write to a temp file and rename so readers never see a half written record
+    tmp_path = f"{self._job_path(job_id)}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(job, f)
+    os.replace(tmp_path, self._job_path(job_id))
@@ -0,0 +1,117 @@
+import argparse
+import concurrent.futures
+import logging
+import os
+import threading
+from multiprocessing.connection import Listener, Client
+
+SEPARATION_MODEL_NAME = "9_HP2-UVR.pth"
+SEPARATION_VR_PARAMS = { "batch_size": 1,"window_size": 512,"aggression": 5,"enable_tta": False,"enable_post_process": False,"post_process_threshold": 0.2,"high_end_process": False }
+DEFAULT_SEPARATION_SERVER_ADDRESS = "/tmp/audio_manipulator_separator.sock"
+
+logger = logging.getLogger("AudioManipulator.SeparationServer")
+
+# build the separator and load the model, the import is done here so http workers
+# using the shared server never load torch and the model themselves.
+# with max_batch_size > 1 concurrent separations share VR inference batches
+def create_separator(output_dir, max_batch_size=1, max_batch_wait_ms=20):
+  from audio_separator.separator import Separator
+  separator = Separator(output_dir=output_dir, vr_params=SEPARATION_VR_PARAMS)
+  separator.load_model(SEPARATION_MODEL_NAME)
+
+  if max_batch_size > 1:
+    from separationBatcher import BatchingSeparator
+    return BatchingSeparator(separator, max_batch_size, max_batch_wait_ms)
+  return separator
+
+# a plain Separator keeps the state of the file being separated on the model instance, so concurrent
+# separate() calls on it overwrite each other. only separators marked thread_safe run concurrently
+def separation_concurrency(separator, max_concurrency):
+  if max_concurrency > 1 and not getattr(separator, "thread_safe", False):
+    logger.warning(f"The separator is not thread safe, running 1 separation at a time instead of {max_concurrency}, set a batch size over 1 to run them concurrently")
+    return 1
+  return max_concurrency
+
+# serves separation requests from the http workers over a local unix socket,
+# the model is loaded once here and all inference is scheduled on a single executor
+class SeparationServer:
+  def __init__(self, separator, address, max_concurrency=1):
+    self.separator = separator
+    self.address = address
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=separation_concurrency(separator, max_concurrency), thread_name_prefix="inference")
+
+  def serve_forever(self):
+    # remove a stale socket left behind by a previous run
+    if os.path.exists(self.address):
+      os.remove(self.address)
+
+    with Listener(self.address, family="AF_UNIX") as listener:
+      os.chmod(self.address, 0o600)
+      logger.info(f"Separation server listening on {self.address}")
+      while True:
+        conn = listener.accept()
+        threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+  def _handle_connection(self, conn):
+    with conn:
+      while True:
+        try:
+          request = conn.recv()
+        except EOFError:
+          break
+
+        op = request.get("op")
+        if op == "ping":
+          conn.send({"status": "ok"})
+        elif op == "separate":
+          conn.send(self._separate(request["file_path"]))
+        else:
+          conn.send({"status": "error", "error": f"Unknown operation: {op}"})
+
+  def _separate(self, file_path):
+    logger.info(f"Separating {file_path}")
+    try:
+      outputs = self.executor.submit(self.separator.separate, file_path).result()
+    except Exception as e:
+      logger.error(f"Error occurred while separating {file_path}: {str(e)}")
+      return {"status": "error", "error": str(e)}
+    return {"status": "ok", "outputs": outputs}
+
+# talks to the separation server, has the same separate() interface as the audio_separator Separator
+class SeparationClient:
+  # every call is a request of its own, the server decides how many run at the same time
+  thread_safe = True
+
+  def __init__(self, address=DEFAULT_SEPARATION_SERVER_ADDRESS):
+    self.address = address
+
+  def _request(self, request):
+    with Client(self.address, family="AF_UNIX") as conn:
+      conn.send(request)
+      return conn.recv()
+
+  def ping(self):
+    return self._request({"op": "ping"})["status"] == "ok"
+
+  def separate(self, file_path):
+    response = self._request({"op": "separate", "file_path": file_path})
+    if response["status"] != "ok":
+      raise Exception(response["error"])
+    return response["outputs"]
+
+def main():
+  parser = argparse.ArgumentParser(description='Shared separation model server')
+  parser.add_argument('--address', type=str, help='Path of the unix socket to listen on', default=DEFAULT_SEPARATION_SERVER_ADDRESS)
+  parser.add_argument('--output_dir', type=str, help='Directory the separated stems are written to', required=True)
+  parser.add_argument('--max_concurrency', type=int, help='Number of separations running at the same time', default=1)
+  parser.add_argument('--max_batch_size', type=int, help='Max number of spectrogram windows run in one inference batch', default=1)
+  parser.add_argument('--max_batch_wait_ms', type=int, help='Max time to wait for other separations to fill a batch', default=20)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+
+  separator = create_separator(args.output_dir, args.max_batch_size, args.max_batch_wait_ms)
+  SeparationServer(separator, args.address, args.max_concurrency).serve_forever()
+
+if __name__ == "__main__":
+  main()
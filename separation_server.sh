@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# starts the shared separation model server in the background, the gunicorn workers
+# reach it over a unix socket so the model is only loaded once per node
+export SEPARATION_SERVER_ADDRESS=${SEPARATION_SERVER_ADDRESS:-/tmp/audio_manipulator_separator.sock}
+SEPARATION_OUTPUT_DIR=${SEPARATION_OUTPUT_DIR:-/workspace/Applio/assets/audios/}
+# concurrent separations share inference batches of up to SEPARATION_MAX_BATCH_SIZE windows.
+# batching is opt-in, raise both together. with a batch size of 1 the separations run one at a time
+SEPARATION_MAX_CONCURRENCY=${SEPARATION_MAX_CONCURRENCY:-1}
+SEPARATION_MAX_BATCH_SIZE=${SEPARATION_MAX_BATCH_SIZE:-1}
+SEPARATION_MAX_BATCH_WAIT_MS=${SEPARATION_MAX_BATCH_WAIT_MS:-20}
+
+start_separation_server() {
+    rm -f "$SEPARATION_SERVER_ADDRESS"
+    python separationServer.py --address "$SEPARATION_SERVER_ADDRESS" --output_dir "$SEPARATION_OUTPUT_DIR" --max_concurrency "$SEPARATION_MAX_CONCURRENCY" --max_batch_size "$SEPARATION_MAX_BATCH_SIZE" --max_batch_wait_ms "$SEPARATION_MAX_BATCH_WAIT_MS" &
+    SEPARATION_SERVER_PID=$!
+    trap 'kill $SEPARATION_SERVER_PID 2> /dev/null' EXIT
+
+    # wait for the model to be loaded before the workers start sending requests
+    echo "Waiting for the separation server to load the model..."
+    while [ ! -S "$SEPARATION_SERVER_ADDRESS" ]; do
+        if ! kill -0 $SEPARATION_SERVER_PID 2> /dev/null; then
+            echo "Separation server failed to start."
+            exit 1
+        fi
+        sleep 1
+    done
+    echo "Separation server is running."
+}
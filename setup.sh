@@ -71,6 +71,8 @@ install_open_telemetry() {
 # Function to run the Audio Manipulator application
 
 start_audio_manipulator() {
+    . ./separation_server.sh
+    start_separation_server
     opentelemetry-instrument gunicorn -w 4 -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 main:app --timeout 300
 }
 
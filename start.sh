@@ -2,9 +2,12 @@
 
 . .venv/bin/activate
 
+. ./separation_server.sh
 
 export OTEL_RESOURCE_ATTRIBUTES=service.name=AudioManipulator
 export OTEL_EXPORTER_OTLP_ENDPOINT=http://174.138.34.94:4317 
 export OTEL_EXPORTER_OTLP_PROTOCOL=grpc   
 
+start_separation_server
+
 opentelemetry-instrument gunicorn -w 4 -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000 main:app --timeout 300
\ No newline at end of file
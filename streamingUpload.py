@@ -0,0 +1,142 @@
+import asyncio
+import os
+from fastapi import HTTPException, Request
+from multipart.multipart import MultipartParser, parse_options_header
+
+# bytes kept in memory before they are written to the file
+WRITE_BUFFER_SIZE = 1024 * 1024
+# max size of the non-file fields of a multipart body
+MAX_FIELDS_BYTES = 64 * 1024
+
+# writes the body to the file in WRITE_BUFFER_SIZE blocks on a thread, so memory stays bounded
+# and the event loop never waits on the disk. raises a 413 once more than max_bytes arrived
+class _BufferedFileWriter:
+  def __init__(self, file_path, max_bytes):
+    self.file_path = file_path
+    self.max_bytes = max_bytes
+    self.buffer = bytearray()
+    self.size = 0
+    self.file = None
+
+  async def open(self):
+    self.file = await asyncio.to_thread(open, self.file_path, "wb")
+
+  def feed(self, data):
+    self.size += len(data)
+    if self.size > self.max_bytes:
+      raise HTTPException(status_code=413, detail=f"The upload is larger than {self.max_bytes} bytes")
+    self.buffer += data
+
+  async def flush(self, force=False):
+    if self.buffer and (force or len(self.buffer) >= WRITE_BUFFER_SIZE):
+      data = bytes(self.buffer)
+      self.buffer.clear()
+      await asyncio.to_thread(self.file.write, data)
+
+  async def close(self):
+    if self.file is not None:
+      await self.flush(force=True)
+      await asyncio.to_thread(self.file.close)
+
+# parses a multipart body as it arrives, the part named file_field (or the first part with a filename)
+# goes to the writer and the other parts are kept as form fields
+class _MultipartReceiver:
+  def __init__(self, boundary, writer, file_field):
+    self.writer = writer
+    self.file_field = file_field
+    self.fields = {}
+    self.fields_size = 0
+    self.found_file = False
+    self._header_field = b""
+    self._header_value = b""
+    self._headers = {}
+    self._part_name = None
+    self._part_is_file = False
+    self._part_value = bytearray()
+    self.parser = MultipartParser(boundary, {
+      "on_part_begin": self._on_part_begin,
+      "on_header_field": self._on_header_field,
+      "on_header_value": self._on_header_value,
+      "on_header_end": self._on_header_end,
+      "on_headers_finished": self._on_headers_finished,
+      "on_part_data": self._on_part_data,
+      "on_part_end": self._on_part_end,
+    })
+
+  def _on_part_begin(self):
+    self._headers = {}
+    self._part_value = bytearray()
+
+  def _on_header_field(self, data, start, end):
+    self._header_field += data[start:end]
+
+  def _on_header_value(self, data, start, end):
+    self._header_value += data[start:end]
+
+  def _on_header_end(self):
+    self._headers[self._header_field.lower()] = self._header_value
+    self._header_field = b""
+    self._header_value = b""
+
+  def _on_headers_finished(self):
+    _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+    self._part_name = options.get(b"name", b"").decode("utf-8", errors="replace")
+    # only one file is written, later file parts are ignored
+    self._part_is_file = not self.found_file and (self._part_name == self.file_field or b"filename" in options)
+    if self._part_is_file:
+      self.found_file = True
+
+  def _on_part_data(self, data, start, end):
+    if self._part_is_file:
+      self.writer.feed(data[start:end])
+    elif self._part_name is not None:
+      self.fields_size += end - start
+      if self.fields_size > MAX_FIELDS_BYTES:
+        raise HTTPException(status_code=413, detail="The form fields are too large")
+      self._part_value += data[start:end]
+
+  def _on_part_end(self):
+    if not self._part_is_file and self._part_name:
+      self.fields[self._part_name] = self._part_value.decode("utf-8", errors="replace")
+    self._part_name = None
+    self._part_is_file = False
+
+# save the body of the request to file_path while it arrives. the body is either the raw file or
+# multipart/form-data with the file in the file_field part. returns the file path, its size and the
+# other form fields. raises a 413 when the body is larger than max_bytes, the partial file is removed
+async def receive_upload(request: Request, file_path, max_bytes, file_field="file"):
+  content_length = request.headers.get("content-length")
+  if content_length is not None and content_length.isdigit() and int(content_length) > max_bytes:
+    raise HTTPException(status_code=413, detail=f"The upload is larger than {max_bytes} bytes")
+
+  content_type, options = parse_options_header(request.headers.get("content-type", ""))
+  writer = _BufferedFileWriter(file_path, max_bytes)
+  receiver = None
+  if content_type == b"multipart/form-data":
+    if b"boundary" not in options:
+      raise HTTPException(status_code=400, detail="The multipart body has no boundary")
+    receiver = _MultipartReceiver(options[b"boundary"], writer, file_field)
+
+  await writer.open()
+  try:
+    async for chunk in request.stream():
+      if receiver is not None:
+        receiver.parser.write(chunk)
+      else:
+        writer.feed(chunk)
+      await writer.flush()
+    if receiver is not None:
+      receiver.parser.finalize()
+      if not receiver.found_file:
+        raise HTTPException(status_code=400, detail=f"The multipart body has no {file_field} file")
+    await writer.close()
+  except BaseException:
+    await writer.close()
+    await asyncio.to_thread(os.remove, file_path)
+    raise
+
+  return {
+    "file_path": file_path,
+    "bytes": writer.size,
+    "fields": receiver.fields if receiver is not None else {},
+  }
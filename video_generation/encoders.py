@@ -0,0 +1,117 @@
+import argparse
+import functools
+import json
+import os
+import subprocess
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CALIBRATION_FILE = os.path.join(SCRIPT_DIR, "encoder_calibration.json")
+CPU_THREADS = os.cpu_count() or 4
+
+# H.264 encoders in order of preference when no calibration was done, hardware encoders first.
+# libx264 is always the fallback, tuned for speed on the CPU-only nodes
+ENCODER_PREFERENCE = ["h264_nvenc", "h264_qsv", "libx264"]
+
+def _encoder_options(name, threads=None):
+    if name == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p1", "-rc", "vbr", "-cq", "27"]
+    if name == "h264_qsv":
+        return ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "27"]
+    if name == "libx264":
+        return ["-c:v", "libx264", "-preset", "veryfast", "-crf", "27", "-threads", str(threads or CPU_THREADS)]
+    raise ValueError(f"Unknown encoder: {name}")
+
+# encode a single frame to find out if the encoder actually works on this node,
+# hardware encoders are listed by ffmpeg even when there is no device for them
+def _encoder_works(name):
+    command = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", "color=c=black:s=256x256:r=30:d=0.1",
+        "-frames:v", "1", *_encoder_options(name), "-pix_fmt", "yuv420p", "-f", "null", "-"
+    ]
+    try:
+        return subprocess.run(command, capture_output=True, timeout=30).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+@functools.lru_cache(maxsize=1)
+def available_encoders():
+    try:
+        listing = subprocess.run(["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return []
+    listed = {line.split()[1] for line in listing.splitlines() if len(line.split()) > 1}
+    return [name for name in ENCODER_PREFERENCE if name in listed and _encoder_works(name)]
+
+def _load_calibration():
+    try:
+        with open(CALIBRATION_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+# pick the encoder for this node: VIDEO_ENCODER if set, else the fastest one from the
+# calibration file, else the first available one in order of preference
+@functools.lru_cache(maxsize=1)
+def select_encoder():
+    if os.environ.get("VIDEO_ENCODER"):
+        return os.environ["VIDEO_ENCODER"]
+
+    available = available_encoders()
+    calibration = _load_calibration()
+    if calibration:
+        calibrated = [name for name in available if name in calibration.get("results", {})]
+        if calibrated:
+            return max(calibrated, key=lambda name: calibration["results"][name])
+
+    return available[0] if available else "libx264"
+
+# ffmpeg video encoding options for the selected encoder, threads only applies to the CPU encoder
+def encoder_args(threads=None):
+    return _encoder_options(select_encoder(), threads)
+
+# render a short reference clip with every available encoder and record the frames per second,
+# the results are saved to the calibration file and used by select_encoder
+def calibrate(output_size="1024x1024", seconds=5):
+    frames = seconds * 30
+    results = {}
+    for name in available_encoders():
+        command = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", f"testsrc2=s={output_size}:r=30:d={seconds}",
+            *_encoder_options(name), "-pix_fmt", "yuv420p", "-f", "null", "-"
+        ]
+        start_time = time.time()
+        if subprocess.run(command, capture_output=True).returncode != 0:
+            print(f"{name}: failed")
+            continue
+        results[name] = frames / (time.time() - start_time)
+        print(f"{name}: {results[name]:.1f} fps")
+
+    calibration = {
+        "output_size": output_size,
+        "results": results,
+        "selected": max(results, key=results.get) if results else None,
+        "calibrated_at": time.time(),
+    }
+    with open(CALIBRATION_FILE, "w") as f:
+        json.dump(calibration, f, indent=2)
+    return calibration
+
+def main():
+    parser = argparse.ArgumentParser(description='Detect and calibrate the video encoders of this node')
+    parser.add_argument('--calibrate', action='store_true', help='Render a reference clip with every encoder and record its speed')
+    parser.add_argument('--output_size', type=str, help='Size of the reference clip', default='1024x1024')
+    parser.add_argument('--seconds', type=int, help='Length of the reference clip in seconds', default=5)
+    args = parser.parse_args()
+
+    if args.calibrate:
+        calibration = calibrate(args.output_size, args.seconds)
+        print(f"Selected encoder: {calibration['selected']}")
+    else:
+        print(f"Available encoders: {available_encoders()}")
+        print(f"Selected encoder: {select_encoder()}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,344 @@
+import asyncio
+import collections
 import subprocess
 import math
 import argparse
 import os
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+try:
+    from video_generation.encoders import encoder_args
+    from video_generation.generate_vinyl_disc_rotation import generate_vinyl_loops, vinyl_loop_path
+except ImportError:
+    # run as a script, python video_generation/generate_video.py
+    from encoders import encoder_args
+    from generate_vinyl_disc_rotation import generate_vinyl_loops, vinyl_loop_path
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# part of the rendered video cache keys, bump it whenever a change to the template changes the rendered video
+TEMPLATE_VERSION = 1
+FPS = 30
+VINYL_IMAGE = os.path.join(SCRIPT_DIR, "vinylDisc.png")
+# the blurred background is the cover scaled down to 10%, blurred and scaled up to the output size
+BLUR_SCALE = 0.10
+BLUR_RADIUS = 6
+# frames of a full vinyl rotation, one rotation every 2 seconds
+VINYL_LOOP_FRAMES = 60
+APP_DOWNLOAD_IMAGE = os.path.join(SCRIPT_DIR, "app_download.png")
+VOX_LOGO_IMAGE = os.path.join(SCRIPT_DIR, "voxLogoRounded.png")
+TEXT_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# max number of ffmpeg renders running at the same time in the process
+RENDER_CONCURRENCY = int(os.environ.get("RENDER_CONCURRENCY", "1"))
+# default number of parallel segments a render is split into, and their minimum length
+RENDER_SEGMENTS = int(os.environ.get("RENDER_SEGMENTS", "1"))
+MIN_SEGMENT_SECONDS = 20
+CPU_THREADS = os.cpu_count() or 4
+# number of ffmpeg stderr lines kept to report a failed render
+STDERR_TAIL_LINES = 50
+
+_render_semaphore = None
+
+class RenderError(Exception):
+    def __init__(self, message, returncode=None, stderr_tail=None):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr_tail = stderr_tail or []
+
+# sizes and positions of the template elements for an output size, the dynamic elements are
+# positioned in the padded frame (pad_top is the height of the padding above the video area)
+class TemplateLayout:
+    def __init__(self, output_size="1024x1024"):
+        self.output_size = output_size
+        self.width, self.height = map(int, output_size.split('x'))
+        self.top_padding = 5
+        self.padded_height_value = int(self.height * 0.20)
+        self.padded_height = self.height + self.padded_height_value
+        # ffmpeg's pad filter used to center the video area, rounded down to even rows for yuv420p
+        self.pad_top = ((self.padded_height - self.height) // 2) & ~1
+
+        self.app_download_height = int(self.padded_height_value * 0.45)
+
+        self.vox_logo_height = int(self.padded_height_value * 0.40)
+        self.vox_logo_x = int(self.width * 0.35)
+        self.vox_logo_y = int(self.padded_height - self.vox_logo_height - (self.padded_height_value / 2 * 0.12))
+
+        self.made_with_text_y = int(self.vox_logo_y + ((self.vox_logo_height / 2) * 0.75))
+        self.made_with_text_x = int(self.vox_logo_x + self.vox_logo_height + 10)
+        self.made_with_text_font_size = int(self.height * 0.030)
+        self.made_with_text_color = "white"
+
+        self.album_cover_size = int(self.height * 0.50)
+        self.album_x = (self.width - self.album_cover_size) // 2
+        self.album_y = (self.height - self.album_cover_size) // 2 + self.pad_top
+
+        self.vinyl_size = self.album_cover_size
+        self.vinyl_x = int(self.album_x + self.album_cover_size * 0.46)
+        self.vinyl_y = (self.height - self.vinyl_size) // 2 + self.pad_top
+
+        self.progress_bar_width = int(self.width * 0.75)
+        self.progress_bar_height = int(self.height * 0.01)
+        self.progress_bar_x = (self.width - self.progress_bar_width) // 2
+        self.progress_bar_y = int(self.height * 0.90) + self.pad_top
+        self.progress_bar_bg_color = "black"
+        self.progress_bar_fg_color = "white"
+
+        self.duration_text_color = "white"
+        self.duration_text_font_size = int(self.height * 0.020)
+        self.elapsed_text_y = self.progress_bar_y + self.progress_bar_height + 10
+        self.remaining_text_x = self.progress_bar_x + self.progress_bar_width - 65
+
+# build the vinyl rotation loop for a size the first time it's used, in this process since it's a single small loop
+def ensure_vinyl_loop(size, frames=VINYL_LOOP_FRAMES):
+    path = vinyl_loop_path(size, frames)
+    if not os.path.exists(path):
+        generate_vinyl_loops([size], [frames], VINYL_IMAGE, workers=1)
+    return path
+
+# blur the cover image into the video background, the same look as
+# convert <cover> -scale 10% -blur 0x6 with ImageMagick but without a process per request
+def blur_cover_image(cover_image, output, output_size="1024x1024"):
+    width, height = map(int, output_size.split('x'))
+    with Image.open(cover_image) as image:
+        image = image.convert("RGB")
+        small = image.resize((max(1, round(image.width * BLUR_SCALE)), max(1, round(image.height * BLUR_SCALE))), Image.BOX)
+        blurred = small.filter(ImageFilter.GaussianBlur(BLUR_RADIUS))
+        blurred.resize((width, height), Image.BICUBIC).save(output, quality=90)
+    return output
+
+def _scale_to_height(image, height):
+    width = max(1, round(image.width * height / image.height))
+    return image.resize((width, height), Image.BICUBIC)
+
+def _paste(base, image, x, y):
+    base.paste(image, (x, y), image if image.mode == "RGBA" else None)
+
+# composite everything that doesn't change during the video into a single frame: the blurred background,
+# the padding, the app download banner, the VOX logo and the "Made with VOX AI" text
+def composite_base_frame(background, layout, output):
+    base = Image.new("RGB", (layout.width, layout.padded_height), "black")
+    with Image.open(background) as image:
+        base.paste(image.convert("RGB").resize((layout.width, layout.height), Image.BICUBIC), (0, layout.pad_top))
+
+    with Image.open(APP_DOWNLOAD_IMAGE) as image:
+        app_download = _scale_to_height(image.convert("RGBA"), layout.app_download_height)
+    _paste(base, app_download, (layout.width - app_download.width) // 2, layout.top_padding)
+
+    with Image.open(VOX_LOGO_IMAGE) as image:
+        _paste(base, _scale_to_height(image.convert("RGBA"), layout.vox_logo_height), layout.vox_logo_x, layout.vox_logo_y)
+
+    font = _load_font(layout.made_with_text_font_size)
+    ImageDraw.Draw(base).text((layout.made_with_text_x, layout.made_with_text_y), "Made with VOX AI", fill=layout.made_with_text_color, font=font, anchor="la")
+
+    base.save(output, compress_level=1)
+    return output
+
+# the text font, Pillow's own font when DejaVu Sans isn't installed
+def _load_font(size):
+    try:
+        return ImageFont.truetype(TEXT_FONT_PATH, size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size=size)
+        except TypeError:
+            # Pillow < 10.1 only has the fixed size bitmap font
+            return ImageFont.load_default()
+
+# scale the album cover once, it's drawn above the vinyl so it can't be part of the base frame
+def scale_cover_image(cover_image, layout, output):
+    with Image.open(cover_image) as image:
+        image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        height = max(1, round(image.height * layout.album_cover_size / image.width))
+        image.resize((layout.album_cover_size, height), Image.BICUBIC).save(output, compress_level=1)
+    return output
+
+# write the static layers of a render next to its output and make sure the vinyl loop for its size
+# is cached, returns the paths of the base frame and the scaled cover
+def prepare_static_layers(cover_image, background, output, output_size="1024x1024"):
+    layout = TemplateLayout(output_size)
+    prefix = os.path.splitext(output)[0]
+    ensure_vinyl_loop(layout.vinyl_size)
+    base_frame = composite_base_frame(background, layout, f"{prefix}_base.png")
+    cover = scale_cover_image(cover_image, layout, f"{prefix}_cover.png")
+    return base_frame, cover
+
+# inputs and filter graph of the video part of the template, from start to start + length seconds of a
+# video of duration seconds. start is added to the time used by the progress bar and the timers
+def _video_inputs_and_filter(layout, base_frame, cover, duration, start=0, length=None, last=True):
+    DURATION = duration
+    LENGTH = duration - start if length is None else length
+    PROGRESS_BAR_SIZE = f"{layout.progress_bar_width}x{layout.progress_bar_height}"
+    # time in the whole video
+    T = f"t+{start}" if start else "t"
+    # the last frame of the video is pushed back a bit so it isn't dropped
+    last_frame_fix = f",\n        setpts='if(gte(T,{LENGTH}-0.01),PTS+0.01/TB,PTS)'" if last else ""
+
+    inputs = [
+        "-framerate", str(FPS), "-i", base_frame,
+        "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{layout.vinyl_size}x{layout.vinyl_size}", "-framerate", str(FPS),
+        "-stream_loop", "-1", "-i", vinyl_loop_path(layout.vinyl_size, VINYL_LOOP_FRAMES),
+        "-framerate", str(FPS), "-i", cover,
+    ]
+    # the single images are decoded once and repeated with the loop filter
+    filter_complex = f"""
+        [0]loop=loop=-1:size=1:start=0,setpts=N/({FPS}*TB),setsar=1[base];
+        [base][1]overlay=x={layout.vinyl_x}:y={layout.vinyl_y}[with_vinyl];
+        [2]loop=loop=-1:size=1:start=0,setpts=N/({FPS}*TB)[cover];
+        [with_vinyl][cover]overlay=x={layout.album_x}:y={layout.album_y}[with_cover];
+        color={layout.progress_bar_bg_color}:s={PROGRESS_BAR_SIZE}:r={FPS},trim=duration={LENGTH}[bg_bar];
+        color={layout.progress_bar_fg_color}:s={PROGRESS_BAR_SIZE}:r={FPS}[fg_bar];
+        [bg_bar][fg_bar]overlay=x='-w+w*min(({T})/({DURATION}-0.1),1)':shortest=1[progress_bar];
+        [with_cover][progress_bar]overlay={layout.progress_bar_x}:{layout.progress_bar_y}[with_progress];
+        [with_progress]drawtext=fontsize={layout.duration_text_font_size}:fontcolor={layout.duration_text_color}:x={layout.progress_bar_x}:y={layout.elapsed_text_y}:text='%{{eif\\:trunc(mod({T}\\,3600)/60)\\:d\\:2}}\\:%{{eif\\:trunc(mod({T}+1\\,60))\\:d\\:2}}':boxborderw=5,
+        drawtext=fontsize={layout.duration_text_font_size}:fontcolor={layout.duration_text_color}:x={layout.remaining_text_x}:y={layout.elapsed_text_y}:text='-\\%{{eif\\:trunc(({DURATION - start}-t)/60)\\:d\\:2}}\\:\\%{{eif\\:trunc(mod({DURATION - start}-t\\,60))\\:d\\:2}}':boxborderw=5{last_frame_fix}
+        [output]
+        """
+    return inputs, filter_complex
+
+# build the ffmpeg command rendering the vinyl video template. base_frame and cover come from
+# prepare_static_layers, only the vinyl, the progress bar and the timers are drawn on every frame
+def build_ffmpeg_command(audio, base_frame, cover, duration, output, output_size="1024x1024", threads=None):
+    inputs, filter_complex = _video_inputs_and_filter(TemplateLayout(output_size), base_frame, cover, duration)
+    return [
+        "ffmpeg", *inputs,
+        "-i", audio,
+        "-filter_complex", filter_complex,
+        "-map", "[output]", "-map", "3:a", "-shortest", "-t", str(duration), *encoder_args(threads), "-pix_fmt", "yuv420p", "-c:a", "aac", output
+    ]
+
+# build the ffmpeg command rendering the video only, from start to start + length seconds
+def build_segment_command(base_frame, cover, duration, start, length, output, output_size="1024x1024", threads=None):
+    last = start + length >= duration
+    inputs, filter_complex = _video_inputs_and_filter(TemplateLayout(output_size), base_frame, cover, duration, start, length, last)
+    return [
+        "ffmpeg", *inputs,
+        "-filter_complex", filter_complex,
+        "-map", "[output]", "-an", "-t", str(length), *encoder_args(threads), "-pix_fmt", "yuv420p", output
+    ]
+
+# join the segments without re-encoding them and add the audio
+def build_concat_command(audio, segment_list, duration, output):
+    return [
+        "ffmpeg",
+        "-f", "concat", "-safe", "0", "-i", segment_list,
+        "-i", audio,
+        "-map", "0:v", "-map", "1:a", "-shortest", "-t", str(duration), "-c:v", "copy", "-c:a", "aac", output
+    ]
+
+# split the video in segments starting on a full vinyl rotation, so the rotation continues
+# across segments. returns a list of (start, length)
+def split_segments(duration, segments):
+    loop_seconds = VINYL_LOOP_FRAMES / FPS
+    length = math.ceil(duration / segments / loop_seconds) * loop_seconds
+    starts = [i * length for i in range(segments) if i * length < duration]
+    return [(start, min(length, duration - start)) for start in starts]
+
+def _get_render_semaphore():
+    global _render_semaphore
+    if _render_semaphore is None:
+        _render_semaphore = asyncio.Semaphore(RENDER_CONCURRENCY)
+    return _render_semaphore
+
+# run ffmpeg as an asyncio subprocess. on_progress(seconds_rendered, duration) is called as ffmpeg
+# reports progress and on_stderr(line) for every stderr line. cancelling the task kills ffmpeg
+async def run_ffmpeg(command, duration=None, on_progress=None, on_stderr=None):
+    # -progress pipe:1 makes ffmpeg write key=value progress lines to stdout
+    command = command[:1] + ["-y", "-nostats", "-progress", "pipe:1"] + command[1:]
+    try:
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        # ffmpeg is missing or can't be executed
+        raise RenderError(f"Failed to start {command[0]}: {e}") from e
+    stderr_tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+
+    async def read_progress():
+        async for line in process.stdout:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+            # out_time_ms is in microseconds as well, older ffmpeg versions only have that one
+            if key in ("out_time_us", "out_time_ms") and value.isdigit() and on_progress is not None:
+                on_progress(int(value) / 1000000, duration)
+
+    async def read_stderr():
+        async for line in process.stderr:
+            text = line.decode(errors="replace").rstrip()
+            stderr_tail.append(text)
+            if on_stderr is not None:
+                on_stderr(text)
+
+    try:
+        await asyncio.gather(read_progress(), read_stderr())
+        returncode = await process.wait()
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+
+    if returncode != 0:
+        raise RenderError(f"ffmpeg exited with code {returncode}", returncode, list(stderr_tail))
+
+# render the vinyl video in-process, at most RENDER_CONCURRENCY renders run at the same time.
+# with segments > 1 the timeline is split and the segments are rendered by parallel ffmpeg processes
+# sharing the cores, then joined with the audio. segments are at least MIN_SEGMENT_SECONDS long
+async def render_video(audio, cover_image, duration, output, background, output_size="1024x1024", on_progress=None, on_stderr=None, segments=None):
+    segments = max(1, min(segments or RENDER_SEGMENTS, int(duration // MIN_SEGMENT_SECONDS)))
+    try:
+        base_frame, cover = await asyncio.to_thread(prepare_static_layers, cover_image, background, output, output_size)
+    except Exception as e:
+        # unreadable images, disk errors, the render fails like a failed ffmpeg run
+        prefix = os.path.splitext(output)[0]
+        for path in (f"{prefix}_base.png", f"{prefix}_cover.png"):
+            if os.path.exists(path):
+                os.remove(path)
+        raise RenderError(f"Failed to prepare the static layers: {e}") from e
+    try:
+        async with _get_render_semaphore():
+            if segments == 1:
+                command = build_ffmpeg_command(audio, base_frame, cover, duration, output, output_size)
+                await run_ffmpeg(command, duration, on_progress, on_stderr)
+            else:
+                await _render_segments(audio, base_frame, cover, duration, output, output_size, segments, on_progress, on_stderr)
+    finally:
+        for path in (base_frame, cover):
+            if os.path.exists(path):
+                os.remove(path)
+
+async def _render_segments(audio, base_frame, cover, duration, output, output_size, segments, on_progress, on_stderr):
+    prefix = os.path.splitext(output)[0]
+    parts = split_segments(duration, segments)
+    threads = max(1, CPU_THREADS // len(parts))
+    segment_paths = [f"{prefix}_segment_{i:03d}.mp4" for i in range(len(parts))]
+    segment_list = f"{prefix}_segments.txt"
+    # seconds rendered by every segment, reported together as the progress of the whole video
+    rendered = [0] * len(parts)
+
+    def segment_progress(i):
+        def update(seconds_rendered, _):
+            rendered[i] = seconds_rendered
+            if on_progress is not None:
+                on_progress(sum(rendered), duration)
+        return update
+
+    tasks = [
+        asyncio.create_task(run_ffmpeg(build_segment_command(base_frame, cover, duration, start, length, path, output_size, threads), length, segment_progress(i), on_stderr))
+        for i, ((start, length), path) in enumerate(zip(parts, segment_paths))
+    ]
+    try:
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # one segment failed or the render was cancelled, stop the other ffmpeg processes
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        with open(segment_list, "w") as f:
+            f.writelines(f"file '{os.path.abspath(path)}'\n" for path in segment_paths)
+        await run_ffmpeg(build_concat_command(audio, segment_list, duration, output), duration, None, on_stderr)
+    finally:
+        for path in segment_paths + [segment_list]:
+            if os.path.exists(path):
+                os.remove(path)
 
 def main():
     
@@ -17,108 +354,22 @@ def main():
     parser.add_argument('--output_size', type=str, help='Output size of the video', default='1024x1024')
     # argument for the blur background image, required
     parser.add_argument('--background', type=str, help='Path to the background image', required=True)
+    # argument for the number of segments rendered in parallel, default is 1
+    parser.add_argument('--segments', type=int, help='Number of segments rendered in parallel', default=1)
 
     args = parser.parse_args()
-    
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # Configurable variables
-    AUDIO_PATH = args.audio
-    DURATION = args.duration
-    FPS = 30
-    TOTAL_FRAMES = DURATION * FPS
-    OUTPUT_SIZE = args.output_size
-    VINYL_IMAGE = os.path.join(script_dir, "vinylDisc.png")
-    VINYL_ROTATION_DIR = os.path.join(script_dir, "vinyl_rotation")
-    VINYL_IMAGE_SEQUENCE = os.path.join(VINYL_ROTATION_DIR, "vinyl_rotation_%03d.png")
-    ALBUM_COVER = args.cover_image
-    BACKGROUND_IMAGE = args.background
-    APP_DOWNLOAD_IMAGE = os.path.join(script_dir, "app_download.png")
-    VOX_LOGO_IMAGE = os.path.join(script_dir, "voxLogoRounded.png")
-    TEXT_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-
-    # Calculate the ratio based on the output size
-    OUTPUT_WIDTH, OUTPUT_HEIGHT = map(int, OUTPUT_SIZE.split('x'))
-    TOP_PADDING = 5
-    PADDED_HEIGHT_PERCENTAGE = 0.20
-    PADDED_HEIGHT_VALUE = int(OUTPUT_HEIGHT * PADDED_HEIGHT_PERCENTAGE)
-    PADDED_HEIGHT = OUTPUT_HEIGHT + PADDED_HEIGHT_VALUE
-    RATIO = OUTPUT_WIDTH // OUTPUT_HEIGHT
-
-    APP_DOWNLOAD_HEIGHT = int(PADDED_HEIGHT_VALUE * 0.45)
-    APP_DOWNLOAD_POSITION_Y = 0
-
-    VOX_LOGO_IMAGE_HEIGHT = int(PADDED_HEIGHT_VALUE * 0.40)
-    VOX_LOGO_IMAGE_POSITION_X = int(OUTPUT_WIDTH * 0.35)
-    VOX_LOGO_IMAGE_POSITION_Y = int(PADDED_HEIGHT - VOX_LOGO_IMAGE_HEIGHT - (PADDED_HEIGHT_VALUE / 2 * 0.12))
-
-    MADE_WITH_TEXT_POSITION_Y = int(VOX_LOGO_IMAGE_POSITION_Y + ((VOX_LOGO_IMAGE_HEIGHT / 2) * 0.75))
-    MADE_WITH_TEXT_POSITION_X = int(VOX_LOGO_IMAGE_POSITION_X + VOX_LOGO_IMAGE_HEIGHT + 10)
-    MADE_WITH_TEXT_FONT_SIZE = int(OUTPUT_HEIGHT * 0.030)
-    MADE_WITH_TEXT_COLOR = "white"
-
-    # Calculate sizes and positions based on output dimensions
-    ALBUM_COVER_SIZE = int(OUTPUT_HEIGHT * 0.50)
-    ALBUM_POSITION_X = (OUTPUT_WIDTH - ALBUM_COVER_SIZE) // 2
-    ALBUM_POSITION_Y = (OUTPUT_HEIGHT - ALBUM_COVER_SIZE) // 2
-
-    VINYL_SIZE = ALBUM_COVER_SIZE
-    VINYL_POSITION_X = int(ALBUM_POSITION_X + ALBUM_COVER_SIZE * 0.46)
-    VINYL_POSITION_Y = (OUTPUT_HEIGHT - VINYL_SIZE) // 2
-
-    PROGRESS_BAR_WIDTH = int(OUTPUT_WIDTH * 0.75)
-    PROGRESS_BAR_HEIGHT = int(OUTPUT_HEIGHT * 0.01)
-    PROGRESS_BAR_SIZE = f"{PROGRESS_BAR_WIDTH}x{PROGRESS_BAR_HEIGHT}"
-    PROGRESS_BAR_POSITION_X = (OUTPUT_WIDTH - PROGRESS_BAR_WIDTH) // 2
-    PROGRESS_BAR_POSITION_Y = int(OUTPUT_HEIGHT * 0.90)
-    PROGRESS_BAR_BG_COLOR = "0x333333"
-    PROGRESS_BAR_FG_COLOR = "0x00FF00"
-
-    DURATION_TEXT_COLOR = "white"
-    DURATION_TEXT_FONT_SIZE = int(OUTPUT_HEIGHT * 0.020)
-    ELAPSED_TEXT_POSITION_Y = PROGRESS_BAR_POSITION_Y + PROGRESS_BAR_HEIGHT + 10
-    REMAINING_TEXT_POSITION_X = PROGRESS_BAR_POSITION_X + PROGRESS_BAR_WIDTH - 65
-
-    ROTATION_SPEED = 1
-
-    OUTPUT_FILE = args.output
-
-    ffmpeg_command = [
-        "ffmpeg",
-        "-loop", "1", "-i", BACKGROUND_IMAGE,
-        "-framerate", "30", "-i", VINYL_IMAGE_SEQUENCE,
-        "-loop", "1", "-i", ALBUM_COVER,
-        "-loop", "1", "-i", APP_DOWNLOAD_IMAGE,
-        "-loop", "1", "-i", VOX_LOGO_IMAGE,
-        "-i", AUDIO_PATH,
-        "-filter_complex",
-        f"""
-        [0]scale={OUTPUT_WIDTH}:{OUTPUT_HEIGHT},setsar=1[bg];
-        [1]scale={VINYL_SIZE}:{VINYL_SIZE},loop=-1:((30*{DURATION}))[rotating];
-        [bg][rotating]overlay=x={VINYL_POSITION_X}:y={VINYL_POSITION_Y}[bg_with_rotating];
-        [2]scale={ALBUM_COVER_SIZE}:-1[ovrl];
-        [bg_with_rotating][ovrl]overlay=x={ALBUM_POSITION_X}:y={ALBUM_POSITION_Y}[with_cover];
-        [3]scale=-1:{APP_DOWNLOAD_HEIGHT}[app_download];
-        [4]scale=-1:{VOX_LOGO_IMAGE_HEIGHT}[vox_logo];
-        color={PROGRESS_BAR_BG_COLOR}:s={PROGRESS_BAR_SIZE}:r=30,trim=duration={DURATION}[bg_bar];
-        color={PROGRESS_BAR_FG_COLOR}:s={PROGRESS_BAR_SIZE}:r=30,
-        geq='r=if(lte(X,min((T/({DURATION}-0.1))*W,W)),255,0):g=if(lte(X,min((T/({DURATION}-0.1))*W,W)),255,0):b=if(lte(X,min((T/({DURATION}-0.1))*W,W)),255,0):a=255',
-        trim=duration={DURATION}[fg_bar];
-        [bg_bar][fg_bar]overlay=0:0[progress_bar];
-        [with_cover][progress_bar]overlay={PROGRESS_BAR_POSITION_X}:{PROGRESS_BAR_POSITION_Y}[with_progress];
-        [with_progress]drawtext=fontsize={DURATION_TEXT_FONT_SIZE}:fontcolor={DURATION_TEXT_COLOR}:x={PROGRESS_BAR_POSITION_X}:y={ELAPSED_TEXT_POSITION_Y}:text='%{{eif\\:trunc(mod(t\\,3600)/60)\\:d\\:2}}\\:%{{eif\\:trunc(mod(t+1\\,60))\\:d\\:2}}':boxborderw=5,
-        drawtext=fontsize={DURATION_TEXT_FONT_SIZE}:fontcolor={DURATION_TEXT_COLOR}:x={REMAINING_TEXT_POSITION_X}:y={ELAPSED_TEXT_POSITION_Y}:text='-\\%{{eif\\:trunc(({DURATION}-t)/60)\\:d\\:2}}\\:\\%{{eif\\:trunc(mod({DURATION}-t\\,60))\\:d\\:2}}':boxborderw=5,
-        setpts='if(gte(T,{DURATION}-0.01),PTS+0.01/TB,PTS)',
-        pad=width={OUTPUT_WIDTH}:height={PADDED_HEIGHT}:x=0:y=(oh-ih)/2:color=black[padded];
-        [padded][app_download]overlay=(main_w-overlay_w)/2:{TOP_PADDING}[with_app_download];
-        [with_app_download][vox_logo]overlay={VOX_LOGO_IMAGE_POSITION_X}:{VOX_LOGO_IMAGE_POSITION_Y}[with_vox_logo];
-        [with_vox_logo]drawtext=fontsize={MADE_WITH_TEXT_FONT_SIZE}:fontcolor={MADE_WITH_TEXT_COLOR}:x={MADE_WITH_TEXT_POSITION_X}:y={MADE_WITH_TEXT_POSITION_Y}:text='Made with VOX AI':boxborderw=5
-        [output]
-        """,
-        "-map", "[output]", "-map", "5:a", "-shortest", "-t", str(DURATION), "-c:v", "h264_nvenc", "-preset", "p1", "-rc", "vbr", "-cq", "27", "-pix_fmt", "yuv420p", "-c:a", "aac", OUTPUT_FILE
-    ]
-    # Run the FFmpeg command synchronously
-    return subprocess.run(ffmpeg_command, check=True)
+
+    if args.segments > 1:
+        return asyncio.run(render_video(args.audio, args.cover_image, args.duration, args.output, args.background, args.output_size, segments=args.segments))
+
+    base_frame, cover = prepare_static_layers(args.cover_image, args.background, args.output, args.output_size)
+    try:
+        ffmpeg_command = build_ffmpeg_command(args.audio, base_frame, cover, args.duration, args.output, args.output_size)
+        # Run the FFmpeg command synchronously
+        return subprocess.run(ffmpeg_command, check=True)
+    finally:
+        os.remove(base_frame)
+        os.remove(cover)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
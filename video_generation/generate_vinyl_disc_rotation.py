@@ -1,12 +1,83 @@
 from PIL import Image
+import argparse
+import concurrent.futures
+import functools
 import math
+import os
+import uuid
 
-def create_rotated_frames(image_path, num_frames):
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+VINYL_IMAGE = os.path.join(SCRIPT_DIR, "vinylDisc.png")
+# pre-scaled vinyl rotation loops as raw RGBA frames, one file per vinyl size and frame count
+VINYL_CACHE_DIR = os.path.join(SCRIPT_DIR, "vinyl_cache")
+
+def create_rotated_frames(image_path, num_frames, output_dir="."):
     img = Image.open(image_path)
     for i in range(num_frames):
         angle = (i / num_frames) * 360
         rotated = img.rotate(-angle, resample=Image.BICUBIC, expand=False)
-        rotated.save(f"vinyl_rotation_{i:03d}.png")
+        rotated.save(os.path.join(output_dir, f"vinyl_rotation_{i:03d}.png"))
+
+def vinyl_loop_path(size, frames):
+    return os.path.join(VINYL_CACHE_DIR, f"vinyl_{size}x{size}_{frames}.rgba")
+
+# rotate one frame at the source resolution and scale it to every size, returns the RGBA bytes per size
+def _rotate_frame(image_path, index, num_frames, sizes):
+    with Image.open(image_path) as img:
+        rotated = img.convert("RGBA").rotate(-(index / num_frames) * 360, resample=Image.BICUBIC, expand=False)
+    return [rotated.resize((size, size), Image.BICUBIC).tobytes() for size in sizes]
+
+# write the rotation loops of every size and frame count into the cache, frames are rotated in parallel
+# on a process pool (or in this process with workers=1) and written in order as they come back.
+# loops already in the cache are kept unless force is set, returns the paths of all the loops
+def generate_vinyl_loops(sizes, frame_counts, image_path=VINYL_IMAGE, workers=None, force=False):
+    os.makedirs(VINYL_CACHE_DIR, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    paths = []
+    try:
+        for num_frames in frame_counts:
+            missing = [size for size in sizes if force or not os.path.exists(vinyl_loop_path(size, num_frames))]
+            paths += [vinyl_loop_path(size, num_frames) for size in sizes]
+            if not missing:
+                continue
+
+            # several processes can build the same loop at the same time, each writes its own file and the last one wins
+            tmp_paths = [f"{vinyl_loop_path(size, num_frames)}.{uuid.uuid4().hex}.tmp" for size in missing]
+            files = [open(tmp_path, "wb") for tmp_path in tmp_paths]
+            try:
+                rotate = functools.partial(_rotate_frame, image_path, num_frames=num_frames, sizes=missing)
+                if executor is not None:
+                    frames = executor.map(rotate, range(num_frames), chunksize=math.ceil(num_frames / (workers * 4)))
+                else:
+                    frames = map(rotate, range(num_frames))
+                for frame in frames:
+                    for f, data in zip(files, frame):
+                        f.write(data)
+                for f, size, tmp_path in zip(files, missing, tmp_paths):
+                    f.close()
+                    os.replace(tmp_path, vinyl_loop_path(size, num_frames))
+            finally:
+                for f, tmp_path in zip(files, tmp_paths):
+                    f.close()
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the vinyl rotation loops used by the video renderer')
+    parser.add_argument('--sizes', type=int, nargs='+', help='Vinyl sizes in pixels', default=[512])
+    parser.add_argument('--frames', type=int, nargs='+', help='Number of frames of a full rotation', default=[60])
+    parser.add_argument('--workers', type=int, help='Number of processes rotating frames', default=os.cpu_count())
+    parser.add_argument('--force', action='store_true', help='Generate the loops even if they are already cached')
+    parser.add_argument('--image', type=str, help='Path to the vinyl image', default=VINYL_IMAGE)
+    args = parser.parse_args()
+
+    for path in generate_vinyl_loops(args.sizes, args.frames, args.image, args.workers, args.force):
+        print(path)
 
 if __name__ == "__main__":
-    create_rotated_frames("vinylDisc.png", 60)
\ No newline at end of file
+    main()